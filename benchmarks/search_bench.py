@@ -0,0 +1,84 @@
+"""Compare searching mapblock data in Python and in SQLite.
+
+Usage: python benchmarks/search_bench.py <map.sqlite> <node name>
+
+All methods read the whole blocks table and count the blocks whose data
+contains the node's name-id map entry, searching for the length-prefixed
+name like BlockSelection does. The map is opened read-only.
+"""
+
+import sys
+import time
+import struct
+import sqlite3
+
+BATCH_SIZE = 1000
+
+
+def search_python(cursor, searchData):
+    """The previous method: read every blob and search it in Python."""
+    cursor.execute("SELECT pos, data FROM blocks")
+    found = 0
+
+    while batch := cursor.fetchmany(BATCH_SIZE):
+        for key, data in batch:
+            if data != None and data.find(searchData) != -1:
+                found += 1
+
+    return found
+
+
+def search_sqlite_keys(cursor, searchData):
+    """Search in SQLite, still returning a key for every row."""
+    cursor.execute("SELECT pos, CASE WHEN instr(data, ?) > 0 THEN data END "
+            "FROM blocks", (searchData,))
+    found = 0
+
+    while batch := cursor.fetchmany(BATCH_SIZE):
+        for key, data in batch:
+            if data != None:
+                found += 1
+
+    return found
+
+
+def search_sqlite(cursor, searchData):
+    """Search in SQLite, returning only matching rows."""
+    cursor.execute("SELECT pos, data FROM blocks WHERE instr(data, ?) > 0",
+            (searchData,))
+    found = 0
+
+    while batch := cursor.fetchmany(BATCH_SIZE):
+        found += len(batch)
+
+    return found
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__.strip())
+        sys.exit(1)
+
+    db = sqlite3.connect(f"file:{sys.argv[1]}?mode=ro", uri=True)
+    cursor = db.cursor()
+    searchNode = sys.argv[2].encode()
+    # Same search data as BlockSelection uses for a search node.
+    searchData = struct.pack(">H", len(searchNode)) + searchNode
+
+    cursor.execute("SELECT COUNT(*) FROM blocks")
+    print(f"{cursor.fetchone()[0]} mapblocks in map.")
+
+    # Read the table once so that all methods start with a warm cache.
+    search_sqlite(cursor, searchData)
+
+    for name, func in (("Python bytes.find", search_python),
+            ("SQLite instr, all keys", search_sqlite_keys),
+            ("SQLite instr, matches only", search_sqlite)):
+        start = time.perf_counter()
+        found = func(cursor, searchData)
+        elapsed = time.perf_counter() - start
+        print(f"{name:28} {elapsed:8.3f}s  {found} mapblocks found")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,236 @@
 import numpy as np
 import struct
-from . import utils
+import zlib
+import collections
+from . import utils, mapblock
 
 
 def clean_nimap(nimap, nodeData):
-    """Removes unused or duplicate name-id mappings."""
-    for nid, name in utils.SafeEnum(nimap):
-        delete = False
-        firstOccur = nimap.index(name)
+    """Removes unused or duplicate name-id mappings.
 
-        if firstOccur < nid:
-            # Name is a duplicate, since we are iterating backwards.
-            nodeData[nodeData == nid] = firstOccur
-            delete = True
+    Names are kept in the order they first appear. Both nimap and
+    nodeData are modified in place.
+    """
 
-        if delete or np.all(nodeData != nid):
-            del nimap[nid]
-            nodeData[nodeData > nid] -= 1
+    # Map each id to the first id with the same name.
+    firstByName = {}
+    firstId = np.array([firstByName.setdefault(name, nid)
+                        for nid, name in enumerate(nimap)], dtype=np.intp)
+
+    counts = np.bincount(nodeData.ravel(), minlength=len(nimap))
+    usedIds = np.flatnonzero(counts[:len(nimap)])
+
+    keep = np.zeros(len(nimap), dtype="bool")
+    keep[firstId[usedIds]] = True
+
+    if len(firstByName) == len(nimap) and keep.all():
+        # Nothing to remove.
+        return
+
+    # Build a lookup table from old to new ids. Ids past the end of the
+    # nimap are shifted down by the number of removed mappings.
+    numRemoved = len(nimap) - np.count_nonzero(keep)
+    lookup = np.arange(len(counts), dtype=np.intp) - numRemoved
+    lookup[:len(nimap)] = (np.cumsum(keep) - 1)[firstId]
+
+    nodeData[...] = lookup[nodeData]
+    nimap[:] = [name for name, kept in zip(nimap, keep) if kept]
+
+
+def get_remap_ids(nimap, mapping):
+    """Plans the replacement of nodes in a whole mapblock.
+
+    Mappings are renamed in place. If a name would then appear twice,
+    the replaced mapping is removed, keeping unreplaced names in their
+    original order. Returns the new nimap and a list of the new id for
+    each old id.
+    """
+
+    unreplaced = {}
+    for nid, name in enumerate(nimap):
+        if name not in mapping:
+            unreplaced.setdefault(name, nid)
+
+    newIds = [None] * len(nimap)
+    newNimap = []
+    replacedIds = {}
+
+    for nid, name in enumerate(nimap):
+        if name in mapping:
+            name = mapping[name]
+            if name in unreplaced or name in replacedIds:
+                continue
+            replacedIds[name] = len(newNimap)
+
+        newIds[nid] = len(newNimap)
+        newNimap.append(name)
+
+    for nid, name in enumerate(nimap):
+        if newIds[nid] == None:
+            name = mapping[name]
+            if name in unreplaced:
+                newIds[nid] = newIds[unreplaced[name]]
+            else:
+                newIds[nid] = replacedIds[name]
+
+    return newNimap, newIds
+
+
+def remap_node_ids(nodeData, newIds, numRemoved):
+    """Remaps nodeData in place using a list of new ids for each old id.
+
+    Ids past the end of the list are shifted down by numRemoved.
+    """
+
+    lookup = np.asarray(newIds, dtype=np.intp)
+    maxId = int(nodeData.max())
+
+    if maxId >= len(lookup):
+        lookup = np.concatenate((lookup,
+                np.arange(len(lookup), maxId + 1, dtype=np.intp) - numRemoved))
+
+    nodeData[...] = lookup[nodeData]
+
+
+def remap_nodes(nimap, nodeData, mapping, mask=None):
+    """Replaces nodes using a dict of {searchName: replaceName} pairs.
+
+    All pairs are applied at once, with a single lookup table from old
+    to new ids. If mask is given, only the nodes it selects are replaced;
+    it can be a boolean array or any other NumPy index, such as a tuple
+    of slices. Both nimap and nodeData are modified in place. Returns
+    False if the nimap contains none of the names to replace.
+    """
+
+    if not any(name in mapping for name in nimap):
+        return False
+
+    if mask is None:
+        (newNimap, newIds) = get_remap_ids(nimap, mapping)
+        remap_node_ids(nodeData, newIds, len(nimap) - len(newNimap))
+        nimap[:] = newNimap
+    else:
+        numIds = max(len(nimap), int(nodeData.max()) + 1)
+        lookup = np.arange(numIds, dtype=np.intp)
+
+        for nid, name in enumerate(nimap[:]):
+            if name in mapping:
+                if mapping[name] not in nimap:
+                    nimap.append(mapping[name])
+                lookup[nid] = nimap.index(mapping[name])
+
+        nodeData[mask] = lookup[nodeData[mask]]
+        # Remove duplicates/unused ID(s).
+        clean_nimap(nimap, nodeData)
+
+    return True
+
+
+class NodeRemap:
+    """Replaces nodes in mapblocks using {searchName: replaceName} pairs.
+
+    The plan for replacing nodes in a whole mapblock only depends on its
+    nimap, so plans are cached by the raw nimap data. Mapblocks with a
+    nimap seen before are remapped without parsing the nimap again.
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.plans = {}
+
+    def _get_plan(self, block):
+        nimapKey = (block.nimap_count, block.nimap_raw)
+        plan = self.plans.get(nimapKey)
+
+        if plan == None:
+            nimap = block.deserialize_nimap()
+
+            if any(name in self.mapping for name in nimap):
+                (newNimap, newIds) = get_remap_ids(nimap, self.mapping)
+                plan = (len(newNimap), mapblock.serialize_nimap(newNimap),
+                        np.array(newIds, dtype=np.intp),
+                        len(nimap) - len(newNimap))
+            else:
+                plan = False
+
+            if len(self.plans) >= self.CACHE_SIZE:
+                self.plans.clear()
+            self.plans[nimapKey] = plan
+
+        return plan
+
+    def matches(self, block):
+        """Returns True if the block's nimap has any names to replace."""
+        return self._get_plan(block) != False
+
+    def apply(self, block, nodeData, mask=None):
+        """Replace nodes in nodeData and the block's nimap.
+
+        If mask is given, only the nodes it selects are replaced (see
+        remap_nodes). nodeData is modified in place, and must be serialized afterwards.
+        """
+
+        if mask is None:
+            plan = self._get_plan(block)
+            if plan == False:
+                return False
+
+            (nimapCount, nimapRaw, newIds, numRemoved) = plan
+            remap_node_ids(nodeData, newIds, numRemoved)
+            block.nimap_count = nimapCount
+            block.nimap_raw = nimapRaw
+            return True
+
+        nimap = block.deserialize_nimap()
+        if not remap_nodes(nimap, nodeData, self.mapping, mask=mask):
+            return False
+
+        block.serialize_nimap(nimap)
+        return True
+
+
+class FillTemplates:
+    """Compressed node data for mapblocks filled with a single node.
+
+    A filled mapblock only uses node id 0, and keeps its param1 and
+    param2 data, so its node data only depends on those. Many mapblocks,
+    such as those deep underground or in open air, have the same params,
+    so their compressed node data is cached and reused instead of being
+    compressed again.
+    """
+
+    CACHE_SIZE = 256
+    # Node ids of a mapblock filled with node id 0.
+    NODE_IDS = bytes(4096 * 2)
+
+    def __init__(self):
+        self.templates = collections.OrderedDict()
+
+    def apply(self, block):
+        """Fill the block's node data with node id 0, keeping its params.
+
+        The block's nimap must be set separately.
+        """
+
+        params = block.node_data_raw[len(self.NODE_IDS):]
+        raw = self.NODE_IDS + params
+        if raw == block.node_data_raw:
+            # Already filled, keep the original data.
+            return
+
+        compressed = self.templates.get(params)
+
+        if compressed == None:
+            compressed = zlib.compress(raw)
+            self.templates[params] = compressed
+            if len(self.templates) > self.CACHE_SIZE:
+                self.templates.popitem(last=False)
+        else:
+            self.templates.move_to_end(params)
+
+        block.set_compressed_node_data(raw, compressed)
 
 
 class MapblockMerge:
@@ -56,22 +270,27 @@ class MapblockMerge:
 
             areaOffset = toArea.p1 - fromArea.p1
 
-            for mIdx, meta in utils.SafeEnum(baseMetadata):
-                pos = utils.Vec3.from_u16_key(meta["pos"])
-                if toArea.contains(pos):
-                    del baseMetadata[mIdx]
+            if baseMetadata:
+                inArea = toArea.contains_many(utils.Vec3Array.from_u16_keys(
+                        [meta["pos"] for meta in baseMetadata]))
+                baseMetadata[:] = [meta for meta, isIn
+                                   in zip(baseMetadata, inArea) if not isIn]
 
             layerMetadata = layer.deserialize_metadata()
-            for meta in layerMetadata:
-                pos = utils.Vec3.from_u16_key(meta["pos"])
-                if fromArea.contains(pos):
-                    meta["pos"] = (pos + areaOffset).to_u16_key()
-                    baseMetadata.append(meta)
-
-            for tIdx, timer in utils.SafeEnum(baseTimers):
-                pos = utils.Vec3.from_u16_key(timer["pos"])
-                if toArea.contains(pos):
-                    del baseTimers[tIdx]
+            if layerMetadata:
+                inArea = fromArea.contains_many(utils.Vec3Array.from_u16_keys(
+                        [meta["pos"] for meta in layerMetadata]))
+                for meta, isIn in zip(layerMetadata, inArea):
+                    if isIn:
+                        pos = utils.Vec3.from_u16_key(meta["pos"])
+                        meta["pos"] = (pos + areaOffset).to_u16_key()
+                        baseMetadata.append(meta)
+
+            if baseTimers:
+                inArea = toArea.contains_many(utils.Vec3Array.from_u16_keys(
+                        [timer["pos"] for timer in baseTimers]))
+                baseTimers[:] = [timer for timer, isIn
+                                 in zip(baseTimers, inArea) if not isIn]
 
         # Clean up duplicate and unused name-id mappings
         clean_nimap(baseNimap, baseND)
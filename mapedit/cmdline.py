@@ -1,5 +1,6 @@
 import argparse
-from . import commands, __version__
+import shlex
+from . import commands, utils, __version__
 
 
 # Define arguments.
@@ -95,6 +96,21 @@ ARGUMENT_DEFS = {
         }
     },
 
+    "mapfile": {
+        "params": {
+            "metavar": "<mapfile>",
+            "help": "Path to a file listing a search node and a replace "
+                    "node on each line"
+        }
+    },
+
+    "script": {
+        "params": {
+            "metavar": "<script>",
+            "help": "Path to a file listing one command on each line"
+        }
+    },
+
     "input_file": {
         "params": {
             "metavar": "<input_file>",
@@ -117,6 +133,59 @@ ARGUMENT_DEFS = {
 }
 
 
+def add_command_parsers(subparsers, commandNames=None):
+    """Add a subparser for each command, or for each of commandNames."""
+    for cmdName, cmdDef in commands.COMMAND_DEFS.items():
+        if commandNames != None and cmdName not in commandNames:
+            continue
+
+        subparser = subparsers.add_parser(cmdName, help=cmdDef["help"])
+
+        for arg, required in cmdDef["args"].items():
+            argsToAdd = ("p1", "p2") if arg == "area" else (arg,)
+
+            for argToAdd in argsToAdd:
+                argDef = ARGUMENT_DEFS[argToAdd]
+
+                if "always_opt" in argDef and argDef["always_opt"]:
+                    # Always use an option flag, even if not required.
+                    subparser.add_argument("--" + argToAdd, required=required,
+                            **argDef["params"])
+                else:
+                    if required:
+                        subparser.add_argument(argToAdd, **argDef["params"])
+                    else:
+                        subparser.add_argument("--" + argToAdd, required=False,
+                                **argDef["params"])
+
+
+class BatchLineParser(argparse.ArgumentParser):
+    """Argument parser which raises ValueError instead of exiting."""
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def parse_batch_line(line):
+    """Parse one line of a batch script into a MapEditArgs object.
+
+    Raises ValueError if the line is not a valid command.
+    """
+
+    parser = BatchLineParser(prog="batch", add_help=False)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_command_parsers(subparsers, commands.BATCH_COMMANDS)
+
+    args = commands.MapEditArgs()
+    try:
+        parser.parse_args(shlex.split(line), namespace=args)
+    except SystemExit:
+        # e.g. from -h.
+        raise ValueError("invalid arguments") from None
+
+    return args
+
+
 def run_cmdline():
     """Run MapEdit as a command-line script."""
 
@@ -134,6 +203,49 @@ def run_cmdline():
             dest="no_warnings",
             action="store_true",
             help="Don't show warnings or confirmation prompts.")
+    parser.add_argument("-j", "--jobs",
+            type=int,
+            default=1,
+            metavar="<jobs>",
+            help="Number of worker processes to use for per-mapblock "
+                 "commands.")
+    parser.add_argument("--threads",
+            type=int,
+            default=1,
+            metavar="<threads>",
+            help="Number of threads to use for decompressing and "
+                 "compressing mapblocks in per-mapblock commands.")
+    parser.add_argument("--db-profile",
+            dest="db_profile",
+            choices=utils.DatabaseHandler.PROFILES.keys(),
+            default="safe",
+            help="SQLite settings to use for the primary map file.")
+    parser.add_argument("--commit-every",
+            dest="commit_every",
+            metavar="<N[MB]>",
+            help="Commit changes after every N modified mapblocks, or "
+                 "every N megabytes of written data.")
+    parser.add_argument("--time-budget",
+            dest="time_budget",
+            type=int,
+            metavar="<seconds>",
+            help="Stop after the given number of seconds. Use the resume "
+                 "command to continue.")
+    parser.add_argument("--memo",
+            type=int,
+            metavar="<MB>",
+            help="Transform identical mapblocks only once, caching up to "
+                 "the given number of megabytes of results.")
+    parser.add_argument("--node-index",
+            dest="node_index",
+            action="store_true",
+            help="Use and update an index of which mapblocks contain each "
+                 "node, stored next to the primary map file.")
+    parser.add_argument("--verify-node-index",
+            dest="verify_node_index",
+            action="store_true",
+            help="Check every mapblock in the node index for changes "
+                 "before running the command.")
     parser.add_argument("--version",
             action="version",
             version="%(prog)s " + __version__)
@@ -141,25 +253,7 @@ def run_cmdline():
     subparsers = parser.add_subparsers(dest="command", required=True,
             help="Command (see README.md for more information)")
 
-    for cmdName, cmdDef in commands.COMMAND_DEFS.items():
-        subparser = subparsers.add_parser(cmdName, help=cmdDef["help"])
-
-        for arg, required in cmdDef["args"].items():
-            argsToAdd = ("p1", "p2") if arg == "area" else (arg,)
-
-            for argToAdd in argsToAdd:
-                argDef = ARGUMENT_DEFS[argToAdd]
-
-                if "always_opt" in argDef and argDef["always_opt"]:
-                    # Always use an option flag, even if not required.
-                    subparser.add_argument("--" + argToAdd, required=required,
-                            **argDef["params"])
-                else:
-                    if required:
-                        subparser.add_argument(argToAdd, **argDef["params"])
-                    else:
-                        subparser.add_argument("--" + argToAdd, required=False,
-                                **argDef["params"])
+    add_command_parsers(subparsers)
 
     # Handle the actual command.
     args = commands.MapEditArgs()
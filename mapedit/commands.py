@@ -1,13 +1,22 @@
+import bisect
 import numpy as np
 import struct
 import re
-from . import mapblock, blockfuncs, utils
+import json
+import time
+import threading
+from . import mapblock, blockfuncs, utils, pipeline, nodeindex
 # TODO: Log failed blocks, etc.
 
 #
 # clone command
 #
 
+# Number of blocks copied by each SQL statement in blockmode. The offset
+# takes up one parameter of the statement.
+COPY_BATCH_SIZE = utils.MAX_SQL_VARIABLES - 1
+
+
 def clone(inst, args):
     offset = args.offset_v
     if args.blockmode:
@@ -28,6 +37,8 @@ def clone(inst, args):
         dstArea = args.area + offset
         blockKeys = utils.get_mapblocks(inst.db, area=dstArea,
                 includePartial=True)
+        # Each source block overlaps up to 8 destination blocks.
+        srcCache = mapblock.MapblockCache(inst.db)
 
     # Sort the block positions based on the direction of the offset.
     # This is to prevent reading from an already modified block.
@@ -35,61 +46,66 @@ def clone(inst, args):
     # Prevent rolling over in the rare case of a block at -2048.
     sortOffset = sortDir.map(lambda n: -1 if n == -1 else 0)
 
-    def sortKey(blockKey):
-        blockPos = utils.Vec3.from_block_key(blockKey)
+    def sortKey(blockKeys):
+        blockPos = utils.Vec3Array.from_block_keys(blockKeys)
         sortPos = blockPos * sortDir + sortOffset
-        return sortPos.to_block_key()
+        return sortPos.to_block_keys()
 
-    blockKeys.sort(key=sortKey)
+    blockKeys = blockKeys[np.argsort(sortKey(blockKeys), kind="stable")]
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
+    if args.blockmode:
+        # Keys correspond to source blocks. Each batch is copied by a
+        # single SQL statement, which reads all of its source blocks
+        # before writing any of them.
+        offsetKey = blockOffset.to_block_key()
+
+        for batch in inst.iter_block_key_batches(blockKeys,
+                COPY_BATCH_SIZE, sortKey=sortKey):
+            isValid = (utils.Vec3Array.from_block_keys(batch) + blockOffset
+                    ).is_valid_block_pos()
+            keys = batch[isValid].tolist()
+            if keys:
+                inst.db.copy_blocks(keys, offsetKey, "main",
+                        condition=mapblock.IS_VALID_GENERATED_SQL)
+
+        return
+
+    for key in inst.iter_block_keys(blockKeys, sortKey=sortKey):
+        # Keys correspond to destination blocks.
         pos = utils.Vec3.from_block_key(key)
+        dstData = inst.db.get_block(key)
+        if not mapblock.is_valid_generated(dstData):
+            continue
 
-        if args.blockmode:
-            # Keys correspond to source blocks.
-            dstPos = pos + blockOffset
-            if not dstPos.is_valid_block_pos():
-                continue
+        dstBlock = mapblock.Mapblock(dstData, searchMetadata=False)
+        merge = blockfuncs.MapblockMerge(dstBlock)
 
-            srcData = inst.db.get_block(key)
-            if not mapblock.is_valid_generated(srcData):
+        dstBlockOverlap = utils.get_block_overlap(pos, dstArea)
+        srcOverlapArea = dstBlockOverlap - offset
+        srcBlocksIncluded = utils.get_mapblock_area(srcOverlapArea,
+                includePartial=True)
+
+        for srcPos in srcBlocksIncluded:
+            if not srcPos.is_valid_block_pos():
                 continue
 
-            inst.db.set_block(dstPos.to_block_key(), srcData, force=True)
-        else:
-            # Keys correspond to destination blocks.
-            dstData = inst.db.get_block(key)
-            if not mapblock.is_valid_generated(dstData):
+            srcBlock = srcCache.get(srcPos.to_block_key())
+            if not srcBlock:
                 continue
 
-            dstBlock = mapblock.Mapblock(dstData)
-            merge = blockfuncs.MapblockMerge(dstBlock)
+            srcBlockFrag = utils.get_block_overlap(srcPos, srcOverlapArea)
+            srcToDestFrag = utils.get_block_overlap(pos,
+                    srcBlockFrag + offset, relative=True)
 
-            dstBlockOverlap = utils.get_block_overlap(pos, dstArea)
-            srcOverlapArea = dstBlockOverlap - offset
-            srcBlocksIncluded = utils.get_mapblock_area(srcOverlapArea,
-                    includePartial=True)
+            srcCornerPos = srcPos * 16
+            merge.add_layer(srcBlock,
+                    srcBlockFrag - srcCornerPos, srcToDestFrag)
 
-            for srcPos in srcBlocksIncluded:
-                if not srcPos.is_valid_block_pos():
-                    continue
+        merge.merge()
+        inst.db.set_block(key, dstBlock.serialize())
+        srcCache.invalidate(key)
 
-                srcData = inst.db.get_block(srcPos.to_block_key())
-                if not mapblock.is_valid_generated(srcData):
-                    continue
-
-                srcBlock = mapblock.Mapblock(srcData)
-                srcBlockFrag = utils.get_block_overlap(srcPos, srcOverlapArea)
-                srcToDestFrag = utils.get_block_overlap(pos,
-                        srcBlockFrag + offset, relative=True)
-
-                srcCornerPos = srcPos * 16
-                merge.add_layer(srcBlock,
-                        srcBlockFrag - srcCornerPos, srcToDestFrag)
-
-            merge.merge()
-            inst.db.set_block(key, dstBlock.serialize())
+    inst.report.append(f"Source block cache: {srcCache.get_stats()}.")
 
 #
 # overlay command
@@ -114,80 +130,73 @@ def overlay(inst, args):
     inst.begin()
 
     if args.blockmode:
-        blockKeys = utils.get_mapblocks(inst.sdb, area=args.area,
-                invert=args.invert, includePartial=False)
+        # Blocks are copied within SQLite, without being read.
+        inst.db.attach(args.input_file, "source")
+        selection = utils.BlockSelection(inst.sdb, area=args.area,
+                invert=args.invert, includePartial=False, withData=False)
+        inst.copy_blocks(selection, "source", blockOffset)
+        return
     else:
         dstArea = args.area + offset
         blockKeys = utils.get_mapblocks(inst.db, area=dstArea,
                 invert=args.invert, includePartial=True)
+        # Each source block overlaps up to 8 destination blocks.
+        srcCache = mapblock.MapblockCache(inst.sdb)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
+    for key in inst.iter_block_keys(blockKeys):
+        # Keys correspond to destination blocks.
         pos = utils.Vec3.from_block_key(key)
+        dstData = inst.db.get_block(key)
+        if not mapblock.is_valid_generated(dstData):
+            continue
 
-        if args.blockmode:
-            # Keys correspond to source blocks.
-            dstPos = pos + blockOffset
-            if not dstPos.is_valid_block_pos():
-                continue
+        dstBlock = mapblock.Mapblock(dstData, searchMetadata=False)
 
+        if args.invert:
+            # Inverted selections currently cannot have an offset.
             srcData = inst.sdb.get_block(key)
             if not mapblock.is_valid_generated(srcData):
                 continue
 
-            inst.db.set_block(dstPos.to_block_key(), srcData, force=True)
+            dstBlockOverlap = utils.get_block_overlap(pos, dstArea,
+                    relative=True)
+            if dstBlockOverlap:
+                srcBlock = mapblock.Mapblock(srcData, searchMetadata=False)
+                merge = blockfuncs.MapblockMerge(srcBlock)
+                merge.add_layer(dstBlock, dstBlockOverlap, dstBlockOverlap)
+                merge.merge()
+                inst.db.set_block(key, srcBlock.serialize())
+            else:
+                inst.db.set_block(key, srcData)
         else:
-            # Keys correspond to destination blocks.
-            dstData = inst.db.get_block(key)
-            if not mapblock.is_valid_generated(dstData):
-                continue
+            merge = blockfuncs.MapblockMerge(dstBlock)
 
-            dstBlock = mapblock.Mapblock(dstData)
+            dstBlockOverlap = utils.get_block_overlap(pos, dstArea)
+            srcOverlapArea = dstBlockOverlap - offset
+            srcBlocksIncluded = utils.get_mapblock_area(srcOverlapArea,
+                    includePartial=True)
 
-            if args.invert:
-                # Inverted selections currently cannot have an offset.
-                srcData = inst.sdb.get_block(key)
-                if not mapblock.is_valid_generated(srcData):
+            for srcPos in srcBlocksIncluded:
+                if not srcPos.is_valid_block_pos():
                     continue
 
-                dstBlockOverlap = utils.get_block_overlap(pos, dstArea,
-                        relative=True)
-                if dstBlockOverlap:
-                    srcBlock = mapblock.Mapblock(srcData)
-                    merge = blockfuncs.MapblockMerge(srcBlock)
-                    merge.add_layer(dstBlock, dstBlockOverlap, dstBlockOverlap)
-                    merge.merge()
-                    inst.db.set_block(key, srcBlock.serialize())
-                else:
-                    inst.db.set_block(key, srcData)
-            else:
-                merge = blockfuncs.MapblockMerge(dstBlock)
-
-                dstBlockOverlap = utils.get_block_overlap(pos, dstArea)
-                srcOverlapArea = dstBlockOverlap - offset
-                srcBlocksIncluded = utils.get_mapblock_area(srcOverlapArea,
-                        includePartial=True)
-
-                for srcPos in srcBlocksIncluded:
-                    if not srcPos.is_valid_block_pos():
-                        continue
+                srcBlock = srcCache.get(srcPos.to_block_key())
+                if not srcBlock:
+                    continue
 
-                    srcData = inst.sdb.get_block(srcPos.to_block_key())
-                    if not mapblock.is_valid_generated(srcData):
-                        continue
+                srcBlockFrag = utils.get_block_overlap(srcPos, srcOverlapArea)
+                srcToDestFrag = utils.get_block_overlap(pos,
+                        srcBlockFrag + offset, relative=True)
 
-                    srcBlock = mapblock.Mapblock(srcData)
-                    srcBlockFrag = utils.get_block_overlap(srcPos,
-                            srcOverlapArea)
-                    srcToDestFrag = utils.get_block_overlap(pos,
-                            srcBlockFrag + offset, relative=True)
+                srcCornerPos = srcPos * 16
+                merge.add_layer(srcBlock, srcBlockFrag - srcCornerPos,
+                        srcToDestFrag)
 
-                    srcCornerPos = srcPos * 16
-                    merge.add_layer(srcBlock, srcBlockFrag - srcCornerPos,
-                            srcToDestFrag)
+            merge.merge()
+            inst.db.set_block(key, dstBlock.serialize())
 
-                merge.merge()
-                inst.db.set_block(key, dstBlock.serialize())
+    if not args.invert:
+        inst.report.append(f"Source block cache: {srcCache.get_stats()}.")
 
 #
 # deleteblocks command
@@ -195,77 +204,113 @@ def overlay(inst, args):
 
 def delete_blocks(inst, args):
     inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db,
-            area=args.area, invert=args.invert)
+    selection = utils.BlockSelection(inst.db, area=args.area,
+            invert=args.invert, withData=False)
+    inst.delete_blocks(selection)
+
+#
+# Memoization of per-block transforms
+#
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        inst.db.delete_block(key)
+def block_area_context(key, args):
+    """Returns the part of args.area inside a mapblock, relative to it.
+
+    Transforms which only depend on a block's position through the area
+    give the same result for identical blocks with the same context.
+    """
+
+    if not args.area:
+        return None
+
+    return utils.get_block_overlap(utils.Vec3.from_block_key(key),
+            args.area, relative=True)
+
+
+def no_context(key, args):
+    """For transforms which don't depend on a block's position at all."""
+    return None
 
 #
 # fill command
 #
 
-def fill(inst, args):
-    # TODO: Option to delete metadata, set param2, etc.
+def fill_block(block, key, args):
     fillNode = args.replacenode_b
 
+    if args.area:
+        blockPos = utils.Vec3.from_block_key(key)
+        overlap = utils.get_block_overlap(blockPos, args.area,
+                relative=True)
+
+    if (args.blockmode or not args.area
+            or overlap == None or overlap.is_full_mapblock()):
+        # Fill the whole mapblock.
+        args.fill_templates.apply(block)
+        block.serialize_nimap([fillNode])
+        return True
+
+    # Fill part of the mapblock.
+    nimap = block.deserialize_nimap()
+    (nodeData, param1, param2) = block.deserialize_node_data()
+
+    if fillNode not in nimap:
+        nimap.append(fillNode)
+    fillId = nimap.index(fillNode)
+
+    nodeData[utils.get_overlap_index(overlap, args.invert)] = fillId
+    # Remove duplicates/unused ID(s).
+    blockfuncs.clean_nimap(nimap, nodeData)
+
+    block.serialize_node_data(nodeData, param1, param2)
+    block.serialize_nimap(nimap)
+    return True
+
+
+def fill(inst, args):
+    # TODO: Option to delete metadata, set param2, etc.
     inst.log("warning",
             "fill will NOT affect param1, param2,\n"
             "node metadata, or node timers. Improper usage\n"
             "could result in unneeded map clutter.")
 
+    args.fill_templates = blockfuncs.FillTemplates()
+
     inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db,
+    selection = utils.BlockSelection(inst.db,
             area=args.area, invert=args.invert,
             includePartial=not args.blockmode)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
-        nimap = block.deserialize_nimap()
-        (nodeData, param1, param2) = block.deserialize_node_data()
+    inst.transform_blocks(selection, fill_block, args,
+            memoContext=block_area_context)
 
-        if args.area:
-            blockPos = utils.Vec3.from_block_key(key)
-            overlap = utils.get_block_overlap(blockPos, args.area,
-                    relative=True)
+#
+# replacenodes command
+#
 
-        if (args.blockmode or not args.area
-                or overlap == None or overlap.is_full_mapblock()):
-            # Fill the whole mapblock.
-            nodeData[:] = 0
-            nimap = [fillNode]
-        else:
-            # Fill part of the mapblock.
-            if fillNode not in nimap:
-                nimap.append(fillNode)
-            fillId = nimap.index(fillNode)
+def replace_nodes_block(block, key, args):
+    if not args.node_remap.matches(block):
+        return False
 
-            if args.invert:
-                mask = np.ones(nodeData.shape, dtype="bool")
-            else:
-                mask = np.zeros(nodeData.shape, dtype="bool")
+    (nodeData, param1, param2) = block.deserialize_node_data()
+    index = None
 
-            mask[overlap.to_array_slices()] = not args.invert
-            nodeData[mask] = fillId
-            # Remove duplicates/unused ID(s).
-            blockfuncs.clean_nimap(nimap, nodeData)
+    if args.area:
+        blockPos = utils.Vec3.from_block_key(key)
+        overlap = utils.get_block_overlap(blockPos, args.area,
+                relative=True)
 
-        block.serialize_node_data(nodeData, param1, param2)
-        block.serialize_nimap(nimap)
-        inst.db.set_block(key, block.serialize())
+        if overlap != None and not overlap.is_full_mapblock():
+            # Replace in a portion of the mapblock.
+            index = utils.get_overlap_index(overlap, args.invert)
+
+    args.node_remap.apply(block, nodeData, mask=index)
+    block.serialize_node_data(nodeData, param1, param2)
+    return True
 
-#
-# replacenodes command
-#
 
 def replace_nodes(inst, args):
     # TODO: Option to delete metadata, param2, etc.
-    searchNode = args.searchnode_b
-    replaceNode = args.replacenode_b
-
-    if searchNode == replaceNode:
+    if args.searchnode_b == args.replacenode_b:
         inst.log("fatal", "Search node and replace node are the same.")
 
     inst.log("warning",
@@ -273,371 +318,526 @@ def replace_nodes(inst, args):
             "node metadata, or node timers. Improper usage\n"
             "could result in unneeded map clutter.")
 
+    args.node_remap = blockfuncs.NodeRemap(
+            {args.searchnode_b: args.replacenode_b})
+
     inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db, searchData=searchNode,
+    selection = utils.BlockSelection(inst.db, searchNode=args.searchnode_b,
             area=args.area, invert=args.invert,
             includePartial=True)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
-        nimap = block.deserialize_nimap()
+    inst.transform_blocks(selection, replace_nodes_block, args,
+            memoContext=block_area_context)
 
-        if searchNode not in nimap:
+#
+# remapnodes command
+#
+
+def read_node_mapping(inst, filename):
+    """Reads a dict of {searchNode: replaceNode} pairs from a file."""
+    nameFormat = re.compile("^[a-zA-Z0-9_]+:[a-zA-Z0-9_]+$")
+    mapping = {}
+
+    try:
+        with open(filename, "r") as f:
+            lines = f.readlines()
+    except OSError as e:
+        inst.log("fatal", f"Failed to read mapping file: {e}")
+
+    for lineNum, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
             continue
 
-        searchId = nimap.index(searchNode)
-        (nodeData, param1, param2) = block.deserialize_node_data()
+        names = line.split()
+        if len(names) != 2:
+            inst.log("fatal", f"Line {lineNum} of mapping file must contain "
+                    "a search node and a replace node.")
 
-        if args.area:
-            blockPos = utils.Vec3.from_block_key(key)
-            overlap = utils.get_block_overlap(blockPos, args.area,
-                    relative=True)
+        for name in names:
+            if name != "air" and nameFormat.match(name) == None:
+                inst.log("fatal", f"Invalid node name on line {lineNum} of "
+                        f"mapping file: '{name}'")
 
-        if (not args.area or overlap == None or overlap.is_full_mapblock()):
-            # Replace in whole mapblock.
-            if replaceNode in nimap:
-                replaceId = nimap.index(replaceNode)
-                # Delete the unneeded node name from the index.
-                del nimap[searchId]
-                nodeData[nodeData == searchId] = replaceId
-                nodeData[nodeData > searchId] -= 1
-            else:
-                nimap[searchId] = replaceNode
-        else:
-            # Replace in a portion of the mapblock.
-            if replaceNode not in nimap:
-                nimap.append(replaceNode)
-            replaceId = nimap.index(replaceNode)
+        searchNode, replaceNode = (bytes(name, "utf-8") for name in names)
 
-            if args.invert:
-                mask = np.ones(nodeData.shape, dtype="bool")
-            else:
-                mask = np.zeros(nodeData.shape, dtype="bool")
+        if searchNode == replaceNode:
+            inst.log("fatal", f"Search node and replace node on line "
+                    f"{lineNum} of mapping file are the same.")
+        if searchNode in mapping:
+            inst.log("fatal", f"Search node on line {lineNum} of mapping "
+                    "file was already given.")
+
+        mapping[searchNode] = replaceNode
 
-            mask[overlap.to_array_slices()] = not args.invert
-            mask &= nodeData == searchId
-            nodeData[mask] = replaceId
-            # Remove duplicates/unused ID(s).
-            blockfuncs.clean_nimap(nimap, nodeData)
+    if not mapping:
+        inst.log("fatal", "Mapping file does not contain any nodes.")
 
-        block.serialize_nimap(nimap)
-        block.serialize_node_data(nodeData, param1, param2)
-        inst.db.set_block(key, block.serialize())
+    return mapping
+
+
+def remap_nodes(inst, args):
+    mapping = read_node_mapping(inst, args.mapfile)
+    args.node_remap = blockfuncs.NodeRemap(mapping)
+
+    inst.log("warning",
+            f"remapnodes will replace {len(mapping)} node(s).\n"
+            "It will NOT affect param1, param2, node metadata,\n"
+            "or node timers. Improper usage could result in\n"
+            "unneeded map clutter.")
+
+    inst.begin()
+    selection = utils.BlockSelection(inst.db,
+            searchNodes=list(mapping),
+            area=args.area, invert=args.invert,
+            includePartial=True)
+
+    inst.transform_blocks(selection, replace_nodes_block, args,
+            memoContext=block_area_context)
 
 #
 # setparam2 command
 #
 
-def set_param2(inst, args):
+def set_param2_block(block, key, args):
     searchNode = args.searchnode_b
 
+    if searchNode:
+        searchId = block.get_nimap_id(searchNode)
+        if searchId == None:
+            # Block doesn't really contain the target node, skip.
+            return False
+
+    (nodeData, param1, param2) = block.deserialize_node_data()
+
+    if args.area:
+        blockPos = utils.Vec3.from_block_key(key)
+        overlap = utils.get_block_overlap(blockPos, args.area,
+                relative=True)
+
+    if not args.area or overlap == None or overlap.is_full_mapblock():
+        # Work on whole mapblock.
+        if searchNode:
+            param2[nodeData == searchId] = args.paramval
+        else:
+            param2[:] = args.paramval
+    else:
+        # Work on partial mapblock.
+        index = utils.get_overlap_index(overlap, args.invert)
+
+        if searchNode:
+            param2[index] = np.where(nodeData[index] == searchId,
+                    args.paramval, param2[index])
+        else:
+            param2[index] = args.paramval
+
+    block.serialize_node_data(nodeData, param1, param2)
+    return True
+
+
+def set_param2(inst, args):
     if args.paramval < 0 or args.paramval > 255:
         inst.log("fatal", "param2 value must be between 0 and 255.")
 
-    if not searchNode and not args.area:
+    if not args.searchnode_b and not args.area:
         inst.log("fatal", "This command requires area and/or searchnode.")
 
     inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db, searchData=searchNode,
+    selection = utils.BlockSelection(inst.db, searchNode=args.searchnode_b,
             area=args.area, invert=args.invert, includePartial=True)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
+    inst.transform_blocks(selection, set_param2_block, args,
+            memoContext=block_area_context)
 
-        if searchNode:
-            nimap = block.deserialize_nimap()
-            try:
-                searchId = nimap.index(searchNode)
-            except ValueError:
-                # Block doesn't really contain the target node, skip.
-                continue
+#
+# Metadata and node timer commands
+#
 
-        (nodeData, param1, param2) = block.deserialize_node_data()
+def get_selected_positions(posKeys, key, args):
+    """Returns a boolean array of which node positions in the mapblock are
+    selected by args.area and args.invert.
 
-        if args.area:
-            blockPos = utils.Vec3.from_block_key(key)
-            overlap = utils.get_block_overlap(blockPos, args.area,
-                    relative=True)
+    posKeys is a list of positions within the mapblock, as u16 keys.
+    """
 
-        if not args.area or overlap == None or overlap.is_full_mapblock():
-            # Work on whole mapblock.
-            if searchNode:
-                param2[nodeData == searchId] = args.paramval
-            else:
-                param2[:] = args.paramval
-        else:
-            # Work on partial mapblock.
-            if args.invert:
-                mask = np.ones(nodeData.shape, dtype="bool")
-            else:
-                mask = np.zeros(nodeData.shape, dtype="bool")
+    cornerPos = utils.Vec3.from_block_key(key) * 16
+    positions = utils.Vec3Array.from_u16_keys(posKeys) + cornerPos
+    return args.area.contains_many(positions) != args.invert
 
-            if overlap:
-                slices = overlap.to_array_slices()
-                mask[slices] = not args.invert
+#
+# deletemeta command
+#
 
-            if searchNode:
-                mask &= nodeData == searchId
+def delete_meta_block(block, key, args):
+    searchNode = args.searchnode_b
 
-            param2[mask] = args.paramval
+    if searchNode:
+        nid = block.get_nimap_id(searchNode)
+        if nid == None:
+            return False
+        searchId = struct.pack(">H", nid)
 
-        block.serialize_node_data(nodeData, param1, param2)
-        inst.db.set_block(key, block.serialize())
+    metaList = block.deserialize_metadata()
+    if not metaList:
+        return False
 
-#
-# deletemeta command
-#
+    if args.area:
+        isSelected = get_selected_positions(
+                [meta["pos"] for meta in metaList], key, args)
 
-def delete_meta(inst, args):
-    if not args.searchnode and not args.area:
-        inst.log("fatal", "This command requires area and/or searchnode.")
+    modified = False
+    for j, meta in utils.SafeEnum(metaList):
+        if args.area and not isSelected[j]:
+            continue
 
-    searchNode = args.searchnode_b
+        if searchNode and block.get_raw_content(meta["pos"]) != searchId:
+            continue
 
-    inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db, searchData=searchNode,
-            area=args.area, invert=args.invert, includePartial=True)
+        del metaList[j]
+        modified = True
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
+    if modified:
+        block.serialize_metadata(metaList)
 
-        if searchNode:
-            nimap = block.deserialize_nimap()
-            if searchNode not in nimap:
-                continue
-            searchId = struct.pack(">H", nimap.index(searchNode))
+    return modified
 
-        if args.area:
-            cornerPos = utils.Vec3.from_block_key(key) * 16
-
-        metaList = block.deserialize_metadata()
-        modified = False
-        for j, meta in utils.SafeEnum(metaList):
-            if args.area:
-                relPos = utils.Vec3.from_u16_key(meta["pos"])
-                if args.area.contains(relPos + cornerPos) == args.invert:
-                    continue
 
-            if searchNode and block.get_raw_content(meta["pos"]) != searchId:
-                continue
+def delete_meta(inst, args):
+    if not args.searchnode and not args.area:
+        inst.log("fatal", "This command requires area and/or searchnode.")
 
-            del metaList[j]
-            modified = True
+    inst.begin()
+    selection = utils.BlockSelection(inst.db, searchNode=args.searchnode_b,
+            area=args.area, invert=args.invert, includePartial=True)
 
-        if modified:
-            block.serialize_metadata(metaList)
-            inst.db.set_block(key, block.serialize())
+    inst.transform_blocks(selection, delete_meta_block, args,
+            memoContext=block_area_context,
+            readsNodeData=bool(args.searchnode_b))
 
 #
 # setmetavar command
 #
 
-def set_meta_var(inst, args):
-    if not args.searchnode and not args.area:
-        # TODO: Warn?
-        inst.log("fatal", "This command requires area and/or searchnode.")
-
+def set_meta_var_block(block, key, args):
     metaKey = args.metakey_b
     metaValue = args.metavalue_b
     searchNode = args.searchnode_b
 
-    inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db, searchData=searchNode,
-            area=args.area, invert=args.invert, includePartial=True)
+    if searchNode:
+        nid = block.get_nimap_id(searchNode)
+        if nid == None:
+            return False
+        searchId = struct.pack(">H", nid)
 
-    for i, blockKey in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(blockKey))
+    metaList = block.deserialize_metadata()
+    if not metaList:
+        return False
 
-        if searchNode:
-            nimap = block.deserialize_nimap()
-            if searchNode not in nimap:
-                continue
-            searchId = struct.pack(">H", nimap.index(searchNode))
+    if args.area:
+        isSelected = get_selected_positions(
+                [meta["pos"] for meta in metaList], key, args)
 
-        if args.area:
-            cornerPos = utils.Vec3.from_block_key(blockKey) * 16
-
-        metaList = block.deserialize_metadata()
-        modified = False
-        for j, meta in enumerate(metaList):
-            if args.area:
-                relPos = utils.Vec3.from_u16_key(meta["pos"])
-                if args.area.contains(cornerPos + relPos) == args.invert:
-                    continue
+    modified = False
+    for j, meta in enumerate(metaList):
+        if args.area and not isSelected[j]:
+            continue
 
-            if searchNode and block.get_raw_content(meta["pos"]) != searchId:
-                continue
+        if searchNode and block.get_raw_content(meta["pos"]) != searchId:
+            continue
 
-            metaVars = blockfuncs.deserialize_metadata_vars(meta["vars"],
-                    meta["numVars"], block.metadata_version)
+        metaVars = blockfuncs.deserialize_metadata_vars(meta["vars"],
+                meta["numVars"], block.metadata_version)
 
-            if metaKey in metaVars:
-                # TODO: Create/delete variables, bytes input.
-                metaVars[metaKey] = (metaValue, metaVars[metaKey][1])
-                metaList[j]["vars"] = blockfuncs.serialize_metadata_vars(
-                        metaVars, block.metadata_version)
-                modified = True
+        if metaKey in metaVars:
+            # TODO: Create/delete variables, bytes input.
+            metaVars[metaKey] = (metaValue, metaVars[metaKey][1])
+            metaList[j]["vars"] = blockfuncs.serialize_metadata_vars(
+                    metaVars, block.metadata_version)
+            modified = True
+
+    if modified:
+        block.serialize_metadata(metaList)
+
+    return modified
 
-        if modified:
-            block.serialize_metadata(metaList)
-            inst.db.set_block(blockKey, block.serialize())
+
+def set_meta_var(inst, args):
+    if not args.searchnode and not args.area:
+        # TODO: Warn?
+        inst.log("fatal", "This command requires area and/or searchnode.")
+
+    inst.begin()
+    selection = utils.BlockSelection(inst.db, searchNode=args.searchnode_b,
+            area=args.area, invert=args.invert, includePartial=True)
+
+    inst.transform_blocks(selection, set_meta_var_block, args,
+            memoContext=block_area_context,
+            readsNodeData=bool(args.searchnode_b))
 
 #
 # replaceininv command
 #
 
-def replace_in_inv(inst, args):
+def replace_in_inv_block(block, key, args):
     searchNode = args.searchnode_b
 
-    inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db, searchData=searchNode,
-            area=args.area, invert=args.invert, includePartial=True)
+    if searchNode:
+        nid = block.get_nimap_id(searchNode)
+        if nid == None:
+            return False
+        searchId = struct.pack(">H", nid)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
+    metaList = block.deserialize_metadata()
+    if not metaList:
+        return False
 
-        if searchNode:
-            nimap = block.deserialize_nimap()
-            if searchNode not in nimap:
-                continue
-            searchId = struct.pack(">H", nimap.index(searchNode))
+    if args.area:
+        isSelected = get_selected_positions(
+                [meta["pos"] for meta in metaList], key, args)
 
-        if args.area:
-            cornerPos = utils.Vec3.from_block_key(key) * 16
-
-        metaList = block.deserialize_metadata()
-        modified = False
-        for j, meta in enumerate(metaList):
-            if args.area:
-                relPos = utils.Vec3.from_u16_key(meta["pos"])
-                if args.area.contains(cornerPos + relPos) == args.invert:
-                    continue
+    modified = False
+    for j, meta in enumerate(metaList):
+        if args.area and not isSelected[j]:
+            continue
 
-            if searchNode and block.get_raw_content(meta["pos"]) != searchId:
-                continue
+        if searchNode and block.get_raw_content(meta["pos"]) != searchId:
+            continue
+
+        invList = meta["inv"].split(b"\n")
+        for k, item in enumerate(invList):
+            splitItem = item.split(b" ", 4)
 
-            invList = meta["inv"].split(b"\n")
-            for k, item in enumerate(invList):
-                splitItem = item.split(b" ", 4)
+            if (splitItem[0] == b"Item" and
+                    splitItem[1] == args.searchitem_b):
+                if args.replaceitem_b == b"Empty":
+                    splitItem = [b"Empty"]
+                else:
+                    splitItem[1] = args.replaceitem_b
+                    # Delete item metadata.
+                    if len(splitItem) == 5 and args.deletemeta:
+                        del splitItem[4]
+
+                invList[k] = b" ".join(splitItem)
+                modified = True
 
-                if (splitItem[0] == b"Item" and
-                        splitItem[1] == args.searchitem_b):
-                    if args.replaceitem_b == b"Empty":
-                        splitItem = [b"Empty"]
-                    else:
-                        splitItem[1] = args.replaceitem_b
-                        # Delete item metadata.
-                        if len(splitItem) == 5 and args.deletemeta:
-                            del splitItem[4]
+        metaList[j]["inv"] = b"\n".join(invList)
 
-                    invList[k] = b" ".join(splitItem)
-                    modified = True
+    if modified:
+        block.serialize_metadata(metaList)
 
-            metaList[j]["inv"] = b"\n".join(invList)
+    return modified
 
-        if modified:
-            block.serialize_metadata(metaList)
-            inst.db.set_block(key, block.serialize())
+
+def replace_in_inv(inst, args):
+    inst.begin()
+    selection = utils.BlockSelection(inst.db, searchNode=args.searchnode_b,
+            area=args.area, invert=args.invert, includePartial=True)
+
+    inst.transform_blocks(selection, replace_in_inv_block, args,
+            memoContext=block_area_context,
+            readsNodeData=bool(args.searchnode_b))
 
 #
 # deletetimers command
 #
 
-def delete_timers(inst, args):
+def delete_timers_block(block, key, args):
     searchNode = args.searchnode_b
 
-    if not searchNode and not args.area:
+    if searchNode:
+        nid = block.get_nimap_id(searchNode)
+        if nid == None:
+            return False
+        searchId = struct.pack(">H", nid)
+
+    timerList = block.deserialize_node_timers()
+    if not timerList:
+        return False
+
+    if args.area:
+        isSelected = get_selected_positions(
+                [timer["pos"] for timer in timerList], key, args)
+
+    modified = False
+    for j, timer in utils.SafeEnum(timerList):
+        if args.area and not isSelected[j]:
+            continue
+
+        if searchNode and block.get_raw_content(timer["pos"]) != searchId:
+            continue
+
+        del timerList[j]
+        modified = True
+
+    if modified:
+        block.serialize_node_timers(timerList)
+
+    return modified
+
+
+def delete_timers(inst, args):
+    if not args.searchnode_b and not args.area:
         # TODO: Warn?
         inst.log("fatal", "This command requires area and/or searchnode.")
 
     inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db, searchData=searchNode,
+    selection = utils.BlockSelection(inst.db, searchNode=args.searchnode_b,
             area=args.area, invert=args.invert, includePartial=True)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
+    inst.transform_blocks(selection, delete_timers_block, args,
+            memoContext=block_area_context,
+            readsNodeData=bool(args.searchnode_b))
+
+#
+# deleteobjects command
+#
+
+ITEM_ENT_NAME = b"__builtin:item"
+ITEMSTRING_FORMAT = re.compile(
+        b'\["itemstring"\] = "(?P<name>[a-zA-Z0-9_:]+)')
 
-        if searchNode:
-            nimap = block.deserialize_nimap()
-            if searchNode not in nimap:
-                continue
-            searchId = struct.pack(">H", nimap.index(searchNode))
 
+def delete_objects_block(block, key, args):
+    searchObj = args.searchobj_b
+
+    objList = block.deserialize_static_objects()
+    modified = False
+    for j, obj in utils.SafeEnum(objList):
         if args.area:
-            cornerPos = utils.Vec3.from_block_key(key) * 16
-
-        timerList = block.deserialize_node_timers()
-        modified = False
-        for j, timer in utils.SafeEnum(timerList):
-            if args.area:
-                relPos = utils.Vec3.from_u16_key(timer["pos"])
-                if args.area.contains(cornerPos + relPos) == args.invert:
-                    continue
+            pos = utils.Vec3.from_v3f1000(obj["pos"])
+            if args.area.contains(pos) == args.invert:
+                continue
+
+        objectData = blockfuncs.deserialize_object_data(obj["data"])
 
-            if searchNode and block.get_raw_content(timer["pos"]) != searchId:
+        if args.items: # Search for item entities.
+            if objectData["name"] != ITEM_ENT_NAME:
                 continue
 
-            del timerList[j]
-            modified = True
+            if searchObj:
+                itemstring = ITEMSTRING_FORMAT.search(objectData["data"])
+                if not itemstring or itemstring.group("name") != searchObj:
+                    continue
+        else: # Search for regular entities (mobs, carts, et cetera).
+            if searchObj and objectData["name"] != searchObj:
+                continue
 
-        if modified:
-            block.serialize_node_timers(timerList)
-            inst.db.set_block(key, block.serialize())
+        del objList[j]
+        modified = True
 
-#
-# deleteobjects command
-#
+    if modified:
+        block.serialize_static_objects(objList)
+
+    return modified
 
-def delete_objects(inst, args):
-    ITEM_ENT_NAME = b"__builtin:item"
-    searchObj = args.searchobj_b
 
+def delete_objects(inst, args):
     inst.begin()
-    blockKeys = utils.get_mapblocks(inst.db,
-            searchData=ITEM_ENT_NAME if args.items else searchObj,
+    selection = utils.BlockSelection(inst.db,
+            searchData=ITEM_ENT_NAME if args.items else args.searchobj_b,
             area=args.area, invert=args.invert, includePartial=True)
 
-    itemstringFormat = re.compile(
-            b'\["itemstring"\] = "(?P<name>[a-zA-Z0-9_:]+)')
+    # Objects are selected by their absolute positions.
+    inst.transform_blocks(selection, delete_objects_block, args,
+            memoContext=no_context, readsNodeData=False)
 
-    for i, key in enumerate(blockKeys):
-        inst.update_progress(i, len(blockKeys))
-        block = mapblock.Mapblock(inst.db.get_block(key))
+#
+# batch command
+#
 
-        objList = block.deserialize_static_objects()
-        modified = False
-        for j, obj in utils.SafeEnum(objList):
-            if args.area:
-                pos = utils.Vec3.from_v3f1000(obj["pos"])
-                if args.area.contains(pos) == args.invert:
-                    continue
+# Commands which can be used in a batch script.
+BATCH_COMMANDS = ("fill", "replacenodes", "remapnodes", "setparam2",
+        "deletemeta", "setmetavar", "replaceininv", "deletetimers",
+        "deleteobjects")
 
-            objectData = blockfuncs.deserialize_object_data(obj["data"])
 
-            if args.items: # Search for item entities.
-                if objectData["name"] != ITEM_ENT_NAME:
-                    continue
+def batch_block(block, key, args):
+    blockPos = utils.Vec3.from_block_key(key)
+    modified = False
 
-                if searchObj:
-                    itemstring = itemstringFormat.search(objectData["data"])
-                    if not itemstring or itemstring.group("name") != searchObj:
-                        continue
-            else: # Search for regular entities (mobs, carts, et cetera).
-                if searchObj and objectData["name"] != searchObj:
-                    continue
+    for transform, opArgs, blockArea, invert, memoContext in args.operations:
+        # Make sure the block is inside/outside the area as specified.
+        if blockArea and blockArea.contains(blockPos) == invert:
+            continue
 
-            del objList[j]
+        if transform(block, key, opArgs):
             modified = True
 
-        if modified:
-            block.serialize_static_objects(objList)
-            inst.db.set_block(key, block.serialize())
+    return modified
+
+
+def batch_context(key, args):
+    blockPos = utils.Vec3.from_block_key(key)
+    context = []
+
+    for transform, opArgs, blockArea, invert, memoContext in args.operations:
+        if blockArea and blockArea.contains(blockPos) == invert:
+            context.append(False)
+        else:
+            context.append(memoContext(key, opArgs))
+
+    return tuple(context)
+
+
+def batch(inst, args):
+    # Imported here, since cmdline imports this module.
+    from . import cmdline
+
+    try:
+        with open(args.script, "r") as f:
+            lines = f.readlines()
+    except OSError as e:
+        inst.log("fatal", f"Failed to read batch script: {e}")
+
+    # Each command records its transform instead of running it.
+    inst.batch_ops = []
+
+    for lineNum, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+
+        try:
+            opArgs = cmdline.parse_batch_line(line)
+        except ValueError as e:
+            inst.log("fatal", f"Invalid command on line {lineNum} of batch "
+                    f"script: {e}")
+
+        try:
+            inst._verify_args(opArgs)
+            COMMAND_DEFS[opArgs.command]["func"](inst, opArgs)
+        except MapEditError:
+            inst.log("fatal", f"Invalid command on line {lineNum} of batch "
+                    "script.")
+
+    args.operations = []
+    readsNodeData = False
+
+    for (selection, transform, opArgs, memoContext,
+            opReadsNodeData) in inst.batch_ops:
+        args.operations.append((transform, opArgs, selection.block_area,
+                selection.invert, memoContext))
+        readsNodeData = readsNodeData or opReadsNodeData
+
+    inst.batch_ops = None
+
+    if not args.operations:
+        inst.log("fatal", "Batch script does not contain any commands.")
+
+    # Only read a single area if all commands use the same one.
+    areas = set((opArgs.area, bool(opArgs.invert))
+                for transform, opArgs, *rest in args.operations)
+    if len(areas) == 1:
+        (area, invert) = areas.pop()
+    else:
+        (area, invert) = (None, False)
+
+    inst.begin()
+    selection = utils.BlockSelection(inst.db, area=area, invert=invert,
+            includePartial=True)
+
+    inst.transform_blocks(selection, batch_block, args,
+            memoContext=batch_context, readsNodeData=readsNodeData)
 
 #
 # vacuum command
@@ -708,6 +908,16 @@ COMMAND_DEFS = {
         }
     },
 
+    "remapnodes": {
+        "func": remap_nodes,
+        "help": "Replace several nodes at once, as listed in a file.",
+        "args": {
+            "mapfile":         True,
+            "area":            False,
+            "invert":          False,
+        }
+    },
+
     "setparam2": {
         "func": set_param2,
         "help": "Set param2 values of a certain node and/or a certain area.",
@@ -776,14 +986,40 @@ COMMAND_DEFS = {
         }
     },
 
+    "batch": {
+        "func": batch,
+        "help": "Run several commands in a single pass over the map.",
+        "args": {
+            "script":           True,
+        }
+    },
+
     "vacuum": {
         "func": vacuum,
         "help": "Vacuum the database. This reduces the size of the database, "
                 "but may take a long time.",
         "args": {}
     },
+
+    "resume": {
+        # Handled by MapEditInstance, which runs the saved command.
+        "func": None,
+        "help": "Resume a job which was stopped by --time-budget or "
+                "interrupted while using --commit-every.",
+        "args": {}
+    },
 }
 
+# Appended to the primary file name to get the node index file name.
+NODE_INDEX_SUFFIX = ".nodeindex"
+
+# Arguments which are not saved with a job, since they only affect how a
+# command is run. --node-index is saved, as it changes which blocks are
+# read by commands with a search node.
+GLOBAL_ARGS = ("command", "file", "no_warnings", "jobs", "threads",
+        "db_profile", "commit_every", "time_budget", "memo",
+        "verify_node_index")
+
 
 class MapEditArgs:
     """Basic class to assign arguments to."""
@@ -796,6 +1032,11 @@ class MapEditError(Exception):
     pass
 
 
+class MapEditInterrupt(Exception):
+    """Raised when a command stops early and can be resumed later."""
+    pass
+
+
 class MapEditInstance:
     """Verifies certain input and handles the execution of commands."""
 
@@ -809,6 +1050,27 @@ class MapEditInstance:
         self.db = None
         self.sdb = None
         self.has_begun = False
+        self.jobs = 1
+        self.threads = 1
+        # Chunk size limits for --commit-every.
+        self.commit_blocks = None
+        self.commit_bytes = None
+        self.last_committed_key = None
+        self.time_budget = None
+        self.deadline = None
+        # Size limit of the transform memo cache for --memo.
+        self.memo_bytes = None
+        # State of a resumable job.
+        self.job_tracking = False
+        self.job_command = None
+        self.job_args = None
+        self.job_checksum = None
+        self.resume_key = None
+        self.resume_checksum = None
+        # Messages printed once the command has finished.
+        self.report = []
+        # Operations recorded while reading a batch script.
+        self.batch_ops = None
 
     def log(self, level, msg):
         if level == "":
@@ -827,6 +1089,10 @@ class MapEditInstance:
             raise MapEditError()
 
     def begin(self, progBar=True):
+        if self.batch_ops != None:
+            # The commands of a batch script are started together.
+            return
+
         if self.print_warnings:
             self.log("warning", self.STANDARD_WARNING)
 
@@ -838,6 +1104,9 @@ class MapEditInstance:
         if progBar:
             self.progress.set_start()
 
+        if self.time_budget:
+            self.deadline = time.time() + self.time_budget
+
     def finalize(self):
         if self.sdb:
             self.sdb.close()
@@ -852,12 +1121,234 @@ class MapEditInstance:
         if self.has_begun:
             self.log("info", "Finished.")
 
+    def _close_databases(self):
+        """Close the databases without committing, after an error."""
+        try:
+            if self.sdb:
+                self.sdb.close()
+        finally:
+            if self.db:
+                self.db.close()
+
     def update_progress(self, completed, total):
         self.progress.update_bar(completed, total)
 
-    def _verify_and_run(self, args):
-        self.print_warnings = not args.no_warnings
+    def checkpoint(self, key):
+        """Called when the mapblocks up to key have been processed.
+
+        Commits the changes made so far if they fill a chunk, as set by
+        --commit-every, or if the time budget has run out. If a job is
+        being tracked, its state is saved along with the changes.
+        """
+
+        outOfTime = self.deadline and time.time() >= self.deadline
+
+        if outOfTime or self._chunk_is_full():
+            if self.job_tracking:
+                self.db.set_job(self.job_command, self.job_args, key,
+                        str(self.job_checksum))
+
+            self.db.commit()
+            self.last_committed_key = key
+
+        if outOfTime:
+            raise MapEditInterrupt()
+
+    def _chunk_is_full(self):
+        """Returns whether the uncommitted changes fill a chunk."""
+        return bool((self.commit_blocks
+                    and self.db.uncommitted_blocks >= self.commit_blocks)
+                or (self.commit_bytes
+                    and self.db.uncommitted_bytes >= self.commit_bytes))
+
+    def _start_job(self, checksum):
+        """Start tracking a job, given the checksum of its block list."""
+        if (self.resume_checksum != None
+                and str(checksum) != self.resume_checksum):
+            self.log("fatal", "Mapblocks have been added or removed since "
+                    "the job was interrupted.\nThe job cannot be resumed.")
+
+        self.job_checksum = checksum
+
+    def iter_block_key_batches(self, blockKeys, batchSize, sortKey=None):
+        """Yields arrays of up to batchSize keys.
+
+        Progress is updated and a checkpoint is made after each array.
+        blockKeys must be an int64 array sorted using sortKey, or in
+        ascending order if sortKey is None. sortKey maps an array of keys
+        to an array of sort keys. When resuming a job, the keys up to and
+        including the last committed key are skipped.
+        """
+
+        if self.job_tracking:
+            if self.resume_key != None:
+                if sortKey:
+                    resumeSortKey = sortKey(
+                            np.array([self.resume_key], dtype=np.int64))[0]
+                    blockKeys = blockKeys[sortKey(blockKeys) > resumeSortKey]
+                else:
+                    blockKeys = blockKeys[blockKeys > self.resume_key]
+
+            self._start_job(utils.KeyChecksum(blockKeys))
+
+        for i in range(0, len(blockKeys), batchSize):
+            self.update_progress(i, len(blockKeys))
+            batch = blockKeys[i:i + batchSize]
+            yield batch
+
+            if self.job_tracking:
+                self.job_checksum.remove_all(batch)
+            self.checkpoint(int(batch[-1]))
+
+    def iter_block_keys(self, blockKeys, sortKey=None):
+        """Yields each key, updating progress and checkpointing as needed.
+
+        See iter_block_key_batches.
+        """
+
+        for batch in self.iter_block_key_batches(blockKeys, 1,
+                sortKey=sortKey):
+            yield int(batch[0])
+
+    def _start_selection(self, selection):
+        """Prepare to process a selection. Returns the number of rows."""
+        if self.job_tracking:
+            selection.start_after(self.resume_key)
+            self._start_job(selection.get_checksum())
+
+        return selection.count()
+
+    def _finish_batch(self, selection, total):
+        """Called after each batch of a selection has been processed."""
+        # Blocks which did not match are processed as well.
+        scannedKeys = selection.batch_keys.popleft()
+        if self.job_tracking:
+            self.job_checksum.remove_all(scannedKeys)
+
+        self.update_progress(selection.scanned, total)
+        if scannedKeys:
+            self.checkpoint(scannedKeys[-1])
+
+    def _write_results(self, selection, batch):
+        """Write the (key, newData) results of a batch of a selection.
+
+        A checkpoint is made as soon as a block fills a chunk, rather than
+        at the end of the batch. The keys scanned up to that block are
+        removed from the front of the batch's keys.
+        """
+
+        scannedKeys = selection.batch_keys[0]
+        done = 0
 
+        for key, data in batch:
+            if data == None:
+                continue
+
+            self.db.set_block(key, data)
+
+            if self._chunk_is_full():
+                if self.job_tracking:
+                    # Rows are read in key order when tracking a job.
+                    end = bisect.bisect_right(scannedKeys, key, done)
+                    self.job_checksum.remove_all(scannedKeys[done:end])
+                    done = end
+                self.checkpoint(key)
+
+        selection.batch_keys[0] = scannedKeys[done:]
+
+    def transform_blocks(self, selection, transform, args,
+            memoContext=None, readsNodeData=True):
+        """Apply a transform to each selected mapblock and save the results.
+
+        transform(block, key, args) must modify the parsed mapblock in
+        place and return True if it changed anything. With more than
+        one job, blocks are parsed, transformed and serialized in worker
+        processes while this process does all database reads and writes.
+
+        With --memo, identical blocks are only transformed once if
+        memoContext(key, args) is also the same; see TransformMemo.
+        readsNodeData tells whether the transform may access the node
+        data, which --threads then decompresses ahead of time.
+        """
+
+        if self.batch_ops != None:
+            # Run the transform later, as part of the batch.
+            self.batch_ops.append((selection, transform, args, memoContext,
+                    readsNodeData))
+            return
+
+        total = self._start_selection(selection)
+
+        if self.memo_bytes and memoContext:
+            memo = pipeline.TransformMemo(memoContext, args, self.memo_bytes)
+        else:
+            memo = None
+
+        # Held while accessing the database, since transform_threaded
+        # reads from another thread.
+        dbLock = threading.Lock()
+
+        if self.jobs > 1:
+            results = pipeline.transform_parallel(selection, transform, args,
+                    self.jobs, memo=memo)
+        elif self.threads > 1:
+            results = pipeline.transform_threaded(selection, transform, args,
+                    self.threads, dbLock, memo=memo,
+                    readsNodeData=readsNodeData)
+        else:
+            results = pipeline.transform_serial(selection, transform, args,
+                    memo=memo)
+
+        try:
+            for batch in results:
+                if memo and self.job_tracking:
+                    # Cached results come first; write them in key order.
+                    batch = sorted(batch)
+
+                with dbLock:
+                    self._write_results(selection, batch)
+                    self._finish_batch(selection, total)
+        finally:
+            results.close()
+
+        if memo:
+            self.report.append(f"Memo cache: {memo.get_stats()}.")
+
+    def delete_blocks(self, selection):
+        """Delete the selected mapblocks."""
+        total = self._start_selection(selection)
+
+        for batch in selection:
+            # Delete each run of selected rows with a single range.
+            self.db.delete_ranges(selection.get_row_ranges(
+                    [key for key, data in batch]))
+            self._finish_batch(selection, total)
+
+    def copy_blocks(self, selection, source, blockOffset):
+        """Copy the selected mapblocks from an attached database.
+
+        Blocks are moved by blockOffset, replacing existing blocks.
+        Blocks which are not fully generated, or which would be moved
+        outside the usable map area, are skipped.
+        """
+
+        total = self._start_selection(selection)
+        offsetKey = blockOffset.to_block_key()
+
+        for batch in selection:
+            keys = np.array([key for key, data in batch], dtype=np.int64)
+            isValid = (utils.Vec3Array.from_block_keys(keys) + blockOffset
+                    ).is_valid_block_pos()
+            keys = keys[isValid].tolist()
+
+            for i in range(0, len(keys), COPY_BATCH_SIZE):
+                self.db.copy_blocks(keys[i:i + COPY_BATCH_SIZE], offsetKey,
+                        source, condition=mapblock.IS_VALID_GENERATED_SQL)
+
+            self._finish_batch(selection, total)
+
+    def _verify_args(self, args):
+        """Check command arguments and convert them for use by commands."""
         if (hasattr(args, "p1") and hasattr(args, "p2") and
                 bool(args.p1) != bool(args.p2)):
             self.log("fatal", "Missing --p1 or --p2 argument.")
@@ -870,6 +1361,10 @@ class MapEditInstance:
         if not args.area and args.has_not_none("invert") and args.invert:
             self.log("fatal", "Cannot invert without a defined area.")
 
+        if (args.has_not_none("verify_node_index") and args.verify_node_index
+                and not (args.has_not_none("node_index") and args.node_index)):
+            self.log("fatal", "--verify-node-index requires --node-index.")
+
         if args.has_not_none("offset"):
             args.offset_v = utils.Vec3(*(n for n in args.offset))
         else:
@@ -900,6 +1395,55 @@ class MapEditInstance:
 
             setattr(args, paramName + "_b", bParam)
 
+    def _verify_and_run(self, args):
+        self.print_warnings = not args.no_warnings
+
+        if args.has_not_none("jobs"):
+            if args.jobs < 1:
+                self.log("fatal", "Number of jobs must be at least 1.")
+            self.jobs = args.jobs
+
+        if args.has_not_none("threads"):
+            if args.threads < 1:
+                self.log("fatal", "Number of threads must be at least 1.")
+            if args.threads > 1 and self.jobs > 1:
+                self.log("fatal", "Cannot use both --jobs and --threads.")
+            self.threads = args.threads
+
+        if args.has_not_none("commit_every"):
+            match = re.fullmatch(r"([0-9]+) *(MB)?", args.commit_every,
+                    flags=re.IGNORECASE)
+            if not match or int(match.group(1)) < 1:
+                self.log("fatal", "Invalid value for --commit-every: "
+                        f"'{args.commit_every}'")
+
+            if match.group(2):
+                self.commit_bytes = int(match.group(1)) * 1024 * 1024
+            else:
+                self.commit_blocks = int(match.group(1))
+
+        if args.has_not_none("time_budget"):
+            if args.time_budget < 1:
+                self.log("fatal", "Time budget must be at least 1 second.")
+            self.time_budget = args.time_budget
+
+        if args.has_not_none("memo"):
+            if args.memo < 1:
+                self.log("fatal", "Memo cache size must be at least 1 MB.")
+            self.memo_bytes = args.memo * 1024 * 1024
+
+        if args.command == "resume":
+            args = self._restore_job(args)
+
+        self.job_tracking = bool(self.commit_blocks or self.commit_bytes
+                or self.time_budget or self.resume_key != None)
+        self.job_command = args.command
+        self.job_args = json.dumps({name: value
+                for name, value in vars(args).items()
+                if name not in GLOBAL_ARGS})
+
+        self._verify_args(args)
+
         # Attempt to open database(s).
         if args.has_not_none("input_file"):
             if args.input_file == args.file:
@@ -911,18 +1455,78 @@ class MapEditInstance:
             except Exception as e:
                 self.log("fatal", f"Failed to open secondary database: {e}")
 
+        if args.has_not_none("db_profile"):
+            dbProfile = args.db_profile
+        else:
+            dbProfile = "safe"
+
         try:
-            self.db = utils.DatabaseHandler(args.file)
+            self.db = utils.DatabaseHandler(args.file, profile=dbProfile)
         except Exception as e:
             self.log("fatal", f"Failed to open primary database: {e}")
 
+        if args.has_not_none("node_index") and args.node_index:
+            indexFile = args.file + NODE_INDEX_SUFFIX
+            try:
+                self.db.node_index = nodeindex.NodeIndex(self.db, indexFile)
+            except Exception as e:
+                self.log("fatal", f"Failed to open node index: {e}")
+
+            if args.has_not_none("verify_node_index"):
+                if args.verify_node_index:
+                    self.db.node_index.verify()
+
         COMMAND_DEFS[args.command]["func"](self, args)
 
+        if self.job_tracking:
+            # The job is complete and does not need to be resumed.
+            self.db.delete_job()
+
+    def _restore_job(self, args):
+        """Returns the arguments of the job saved in the primary file."""
+        try:
+            db = utils.DatabaseHandler(args.file)
+            job = db.get_job()
+            db.close()
+        except Exception as e:
+            self.log("fatal", f"Failed to open primary database: {e}")
+
+        if not job:
+            self.log("fatal", "No job to resume was found in the map file.")
+
+        (command, savedArgs, self.resume_key, self.resume_checksum) = job
+        self.log("info", f"Resuming {command} command.")
+
+        jobArgs = MapEditArgs()
+        for name in GLOBAL_ARGS:
+            setattr(jobArgs, name, getattr(args, name, None))
+        for name, value in json.loads(savedArgs).items():
+            setattr(jobArgs, name, value)
+
+        jobArgs.command = command
+        return jobArgs
+
     def run(self, args):
+        finished = True
+
         try:
             self._verify_and_run(args)
         except MapEditError:
             pass
+        except MapEditInterrupt:
+            finished = False
+        except BaseException:
+            # e.g. KeyboardInterrupt. Still restore the database settings.
+            self._close_databases()
+            raise
+
+        self.progress.update_final(finished=finished)
+
+        for msg in self.report:
+            self.log("info", msg)
+
+        if not finished:
+            self.log("info", "Time budget exceeded. Progress has been saved; "
+                    "use the\nresume command to continue.")
 
-        self.progress.update_final()
         self.finalize()
@@ -1,6 +1,8 @@
 import numpy as np
 import zlib
 import struct
+import collections
+import functools
 from . import utils
 
 MIN_BLOCK_VER = 25
@@ -15,11 +17,70 @@ def is_valid_generated(blob):
             blob[1] & 0x08 == 0)
 
 
+# SQL version of is_valid_generated, for the data column of a blocks table.
+IS_VALID_GENERATED_SQL = (
+        f"hex(substr(data, 1, 1)) BETWEEN '{MIN_BLOCK_VER:02X}' "
+        f"AND '{MAX_BLOCK_VER:02X}' "
+        # Flag 0x08 is not set.
+        "AND substr(hex(substr(data, 2, 1)), 2, 1) < '8' "
+        "AND length(data) > 2")
+
+
+# Number of distinct name-id maps to cache. Most worlds only contain a few
+# thousand, since many mapblocks use the same nodes in the same order.
+NIMAP_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=NIMAP_CACHE_SIZE)
+def parse_nimap(count, raw):
+    """Returns a tuple of the node names in a raw name-id map."""
+    nimapList = [None] * count
+    c = 0
+
+    for i in range(count):
+        # Parse node id and node name length.
+        (nid, strSize) = struct.unpack(">HH", raw[c:c+4])
+        # Parse node name
+        c += 4
+        name = raw[c:c+strSize]
+        c += strSize
+
+        nimapList[nid] = name
+
+    return tuple(nimapList)
+
+
+@functools.lru_cache(maxsize=NIMAP_CACHE_SIZE)
+def find_nimap_id(count, raw, name):
+    """Returns the first id of a node name in a raw name-id map, or None."""
+    nimap = parse_nimap(count, raw)
+    return nimap.index(name) if name in nimap else None
+
+
+def serialize_nimap(nimapList):
+    """Returns the raw name-id map for a list of node names."""
+    blob = b""
+
+    for nid in range(len(nimapList)):
+        blob += struct.pack(">HH", nid, len(nimapList[nid]))
+        blob += nimapList[nid]
+
+    return blob
+
+
 class MapblockParseError(Exception):
     """Error parsing mapblock."""
     pass
 
 
+class MetadataSearchError(MapblockParseError):
+    """The node metadata found by searching doesn't follow the node data.
+
+    The mapblock must be parsed again with searchMetadata=False.
+    """
+    pass
+
+
 class Mapblock:
     """Stores a parsed version of a mapblock.
 
@@ -28,7 +89,7 @@ class Mapblock:
     functions called by those methods.
     """
 
-    def __init__(self, blob):
+    def __init__(self, blob, searchMetadata=True):
         self.version = blob[0]
 
         if self.version < MIN_BLOCK_VER or self.version > MAX_BLOCK_VER:
@@ -50,17 +111,105 @@ class Mapblock:
         if self.content_width != 2 or self.params_width != 2:
             raise MapblockParseError("Unsupported content and/or param width")
 
-        # Decompress node data. This stores a node type id, param1 and param2
-        # for each node.
-        decompresser = zlib.decompressobj()
-        self.node_data_raw = decompresser.decompress(blob[c+2:])
-        c = len(blob) - len(decompresser.unused_data)
-
-        # Decompress node metadata.
-        decompresser = zlib.decompressobj()
-        self.node_metadata = decompresser.decompress(blob[c:])
-        c = len(blob) - len(decompresser.unused_data)
-
+        # Node data is only decompressed when it is first accessed. This
+        # stores a node type id, param1 and param2 for each node.
+        self._blob = blob
+        self._node_data_raw = None
+        self._node_data_start = c + 2
+
+        c = self._find_metadata() if searchMetadata else None
+
+        if c == None:
+            # Fall back to decompressing both streams in order.
+            decompresser = zlib.decompressobj()
+            self._node_data_raw = decompresser.decompress(
+                    blob[self._node_data_start:])
+            c = len(blob) - len(decompresser.unused_data)
+            self._metadata_start = c
+
+            decompresser = zlib.decompressobj()
+            self._node_metadata = decompresser.decompress(blob[c:])
+            c = len(blob) - len(decompresser.unused_data)
+
+        self._metadata_end = c
+
+        # Unmodified streams are copied as-is when serializing.
+        self.node_data_modified = False
+        # Compressed node data given by set_compressed_node_data.
+        self._node_data_compressed = None
+        self.node_metadata_modified = False
+
+        self._parse_tail(blob, c)
+
+    def _find_metadata(self):
+        """Locate and decompress the node metadata without the node data.
+
+        The end of a zlib stream can't be found without decompressing it,
+        so instead the metadata stream is found by searching backwards
+        for a zlib header from which the metadata and the rest of the
+        mapblock can be parsed exactly to the end of the data.
+
+        Returns the position after the metadata, or None if no match was
+        found.
+        """
+
+        blob = self._blob
+        view = memoryview(blob)
+        p = len(blob) - 1
+
+        while True:
+            p = blob.rfind(b"\x78", self._node_data_start, p)
+            if p == -1:
+                return None
+
+            # Check the zlib header checksum, and that no dictionary is used.
+            if ((blob[p] << 8 | blob[p+1]) % 31 != 0
+                    or blob[p+1] & 0x20 != 0):
+                continue
+
+            decompresser = zlib.decompressobj()
+            try:
+                metadata = decompresser.decompress(view[p:])
+            except zlib.error:
+                continue
+
+            if not decompresser.eof:
+                continue
+
+            c = len(blob) - len(decompresser.unused_data)
+            if self._tail_size(blob, c) == len(blob) - c:
+                self._metadata_start = p
+                self._node_metadata = metadata
+                return c
+
+    @staticmethod
+    def _tail_size(blob, c):
+        """Returns the size of the data following the node metadata.
+
+        Returns None if the data can't be parsed.
+        """
+
+        try:
+            start = c
+            (objVersion, count) = struct.unpack(">BH", blob[c:c+3])
+            c += 3
+            for i in range(count):
+                c += 15 + struct.unpack(">H", blob[c+13:c+15])[0]
+
+            (nimapVersion, count) = struct.unpack(">BH", blob[c+4:c+7])
+            c += 7
+            for i in range(count):
+                c += 4 + struct.unpack(">H", blob[c+2:c+4])[0]
+
+            (datalen, count) = struct.unpack(">BH", blob[c:c+3])
+            if nimapVersion != 0 or datalen != 10:
+                return None
+
+            return c + 3 + count * 10 - start
+        except struct.error:
+            return None
+
+    def _parse_tail(self, blob, c):
         # Parse static objects.
         self.static_object_version = blob[c]
         self.static_object_count = struct.unpack(">H", blob[c+1:c+3])[0]
@@ -102,7 +251,56 @@ class Mapblock:
         # Get raw node timers. Includes version and count.
         self.node_timers_raw = blob[c:]
 
+    @property
+    def node_data_raw(self):
+        if self._node_data_raw == None:
+            decompresser = zlib.decompressobj()
+            nodeData = decompresser.decompress(
+                    memoryview(self._blob)[self._node_data_start:])
+
+            if (len(self._blob) - len(decompresser.unused_data)
+                    != self._metadata_start):
+                raise MetadataSearchError("Node data doesn't end where the "
+                        "node metadata was found")
+
+            self._node_data_raw = nodeData
+
+        return self._node_data_raw
+
+    @node_data_raw.setter
+    def node_data_raw(self, value):
+        if value != self._node_data_raw:
+            self._node_data_raw = value
+            self._node_data_compressed = None
+            self.node_data_modified = True
+
+    def set_compressed_node_data(self, raw, compressed):
+        """Set the node data, along with the same data already compressed.
+
+        The compressed data is written as-is when serializing.
+        """
+
+        self._node_data_raw = raw
+        self._node_data_compressed = compressed
+        self.node_data_modified = True
+
+    @property
+    def node_metadata(self):
+        return self._node_metadata
+
+    @node_metadata.setter
+    def node_metadata(self, value):
+        if value != self._node_metadata:
+            self._node_metadata = value
+            self.node_metadata_modified = True
+
     def serialize(self):
+        if self._node_data_raw == None:
+            # Everything after the node data was parsed from where the
+            # node metadata was found, which is only checked against the
+            # end of the node data once it is decompressed.
+            self.node_data_raw
+
         blob = b""
 
         blob += struct.pack("BB", self.version, self.flags)
@@ -112,8 +310,17 @@ class Mapblock:
 
         blob += struct.pack("BB", self.content_width, self.params_width)
 
-        blob += zlib.compress(self.node_data_raw)
-        blob += zlib.compress(self.node_metadata)
+        if self._node_data_compressed != None:
+            blob += self._node_data_compressed
+        elif self.node_data_modified:
+            blob += zlib.compress(self.node_data_raw)
+        else:
+            blob += self._blob[self._node_data_start:self._metadata_start]
+
+        if self.node_metadata_modified:
+            blob += zlib.compress(self.node_metadata)
+        else:
+            blob += self._blob[self._metadata_start:self._metadata_end]
 
         blob += struct.pack(">BH",
                 self.static_object_version, self.static_object_count)
@@ -151,30 +358,15 @@ class Mapblock:
         )
 
     def deserialize_nimap(self):
-        nimapList = [None] * self.nimap_count
-        c = 0
-
-        for i in range(self.nimap_count):
-            # Parse node id and node name length.
-            (nid, strSize) = struct.unpack(">HH", self.nimap_raw[c:c+4])
-            # Parse node name
-            c += 4
-            name = self.nimap_raw[c:c+strSize]
-            c += strSize
-
-            nimapList[nid] = name
+        return list(parse_nimap(self.nimap_count, self.nimap_raw))
 
-        return nimapList
+    def get_nimap_id(self, name):
+        """Returns the id of a node name in the nimap, or None."""
+        return find_nimap_id(self.nimap_count, self.nimap_raw, name)
 
     def serialize_nimap(self, nimapList):
-        blob = b""
-
-        for nid in range(len(nimapList)):
-            blob += struct.pack(">HH", nid, len(nimapList[nid]))
-            blob += nimapList[nid]
-
         self.nimap_count = len(nimapList)
-        self.nimap_raw = blob
+        self.nimap_raw = serialize_nimap(nimapList)
 
     def deserialize_metadata(self):
         metaList = []
@@ -311,3 +503,47 @@ class Mapblock:
                     timer["pos"], timer["timeout"], timer["elapsed"])
 
         self.node_timers_raw = blob
+
+
+class MapblockCache:
+    """Least-recently-used cache of parsed mapblocks from a database.
+
+    Missing and ungenerated mapblocks are cached as None. Keys must be
+    invalidated if the database is written to at that key.
+    """
+
+    DEFAULT_SIZE = 2048
+
+    def __init__(self, database, size=DEFAULT_SIZE):
+        self.database = database
+        self.size = size
+        self.blocks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the parsed mapblock at key, or None."""
+        if key in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+
+        self.misses += 1
+        data = self.database.get_block(key)
+        # Cached blocks are merged, which reads their node data.
+        if is_valid_generated(data):
+            block = Mapblock(data, searchMetadata=False)
+        else:
+            block = None
+
+        self.blocks[key] = block
+        if len(self.blocks) > self.size:
+            self.blocks.popitem(last=False)
+
+        return block
+
+    def invalidate(self, key):
+        self.blocks.pop(key, None)
+
+    def get_stats(self):
+        return f"{self.hits} hits, {self.misses} misses"
@@ -0,0 +1,184 @@
+import hashlib
+from . import mapblock
+
+
+def get_hash(data):
+    """Returns a 64-bit hash of mapblock data."""
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def get_node_names(data):
+    """Returns the set of node names in a mapblock's name-id map.
+
+    Mapblocks which cannot be parsed have no names.
+    """
+
+    try:
+        names = mapblock.Mapblock(data).deserialize_nimap()
+    except Exception:
+        return set()
+
+    return set(name for name in names if name != None)
+
+
+class NodeIndex:
+    """Sidecar database mapping node names to the mapblocks using them.
+
+    The index is attached to the map database, so it is updated and
+    committed along with the map. For each mapblock, the length and
+    hash of the indexed data are stored. Before each lookup, blocks in
+    the searched area which were added, removed or changed length since
+    they were indexed are indexed again. The hash is checked when a
+    block is read, and by verify.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, database, filename):
+        self.database = database
+        self.cursor = database.database.cursor()
+        self.read_cursor = database.database.cursor()
+
+        self.cursor.execute("ATTACH DATABASE ? AS nodeindex", (filename,))
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS nodeindex.blocks "
+                "(pos INTEGER PRIMARY KEY, length INTEGER, hash INTEGER)")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS nodeindex.names "
+                "(id INTEGER PRIMARY KEY, name BLOB UNIQUE)")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS nodeindex.nodes "
+                "(name_id INTEGER, pos INTEGER, PRIMARY KEY (name_id, pos)) "
+                "WITHOUT ROWID")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS "
+                "nodeindex.nodes_pos ON nodes (pos)")
+
+        self.cursor.execute("SELECT name, id FROM nodeindex.names")
+        self.name_ids = dict(self.cursor.fetchall())
+
+    def _get_name_id(self, name):
+        if name not in self.name_ids:
+            self.cursor.execute("INSERT INTO nodeindex.names (name) "
+                    "VALUES (?)", (name,))
+            self.name_ids[name] = self.cursor.lastrowid
+
+        return self.name_ids[name]
+
+    def update_blocks(self, rows):
+        """Index a list of (key, data) rows."""
+        nodes = []
+        blocks = []
+
+        for key, data in rows:
+            if data == None:
+                data = b""
+            for name in get_node_names(data):
+                nodes.append((self._get_name_id(name), key))
+            blocks.append((key, len(data), get_hash(data)))
+
+        self.cursor.executemany("DELETE FROM nodeindex.nodes WHERE pos = ?",
+                [(key,) for key, data in rows])
+        self.cursor.executemany("INSERT OR IGNORE INTO nodeindex.nodes "
+                "VALUES (?, ?)", nodes)
+        self.cursor.executemany("INSERT OR REPLACE INTO nodeindex.blocks "
+                "VALUES (?, ?, ?)", blocks)
+
+    def check_blocks(self, rows, hashes):
+        """Index (key, data) rows again if they don't match their hashes.
+
+        This finds blocks which changed without their length changing.
+        """
+
+        self.update_blocks([(key, data) for key, data in rows
+                            if get_hash(data) != hashes[key]])
+
+    def remove_ranges(self, keyRanges):
+        """Remove all blocks in the given (first, last) key ranges.
+
+        Blocks which still exist are indexed again by the next sync.
+        """
+
+        self.cursor.executemany("DELETE FROM nodeindex.nodes "
+                "WHERE pos BETWEEN ? AND ?", keyRanges)
+        self.cursor.executemany("DELETE FROM nodeindex.blocks "
+                "WHERE pos BETWEEN ? AND ?", keyRanges)
+
+    def sync(self, keyRanges=None):
+        """Index blocks which were added, removed or changed length.
+
+        If keyRanges is given, only blocks in those (first, last) key
+        ranges are checked. Blocks which changed without their length
+        changing are found by check_blocks when they are read, or by
+        verify.
+        """
+
+        self.database.flush()
+
+        if keyRanges == None:
+            # Check the whole table, including any invalid keys.
+            keyRanges = [(-2**63, 2**63 - 1)]
+
+        self.cursor.executemany("DELETE FROM nodeindex.nodes "
+                "WHERE pos BETWEEN ? AND ? AND NOT EXISTS "
+                "(SELECT 1 FROM main.blocks b WHERE b.pos = nodes.pos)",
+                keyRanges)
+        self.cursor.executemany("DELETE FROM nodeindex.blocks "
+                "WHERE pos BETWEEN ? AND ? AND NOT EXISTS "
+                "(SELECT 1 FROM main.blocks b WHERE b.pos = blocks.pos)",
+                keyRanges)
+
+        count = 0
+
+        for first, last in keyRanges:
+            # length() does not need to read the data of each block.
+            self.read_cursor.execute("SELECT b.pos, b.data "
+                    "FROM main.blocks b "
+                    "LEFT JOIN nodeindex.blocks i ON i.pos = b.pos "
+                    "WHERE b.pos BETWEEN ? AND ? "
+                    "AND (i.pos IS NULL OR i.length != length(b.data))",
+                    (first, last))
+
+            while rows := self.read_cursor.fetchmany(self.BATCH_SIZE):
+                self.update_blocks(rows)
+                count += len(rows)
+                print(f"\rUpdating node index... {count} mapblocks indexed.",
+                        end="")
+
+        if count:
+            print()
+
+    def verify(self):
+        """Index all blocks which have changed in any way.
+
+        Unlike sync, this compares the hash of every block, which reads
+        the whole map.
+        """
+
+        self.sync()
+
+        self.read_cursor.execute("SELECT b.pos, b.data, i.hash "
+                "FROM main.blocks b "
+                "JOIN nodeindex.blocks i ON i.pos = b.pos")
+        checked = 0
+        count = 0
+
+        while rows := self.read_cursor.fetchmany(self.BATCH_SIZE):
+            changed = [(key, data) for key, data, oldHash in rows
+                       if get_hash(data or b"") != oldHash]
+            self.update_blocks(changed)
+            checked += len(rows)
+            count += len(changed)
+            print(f"\rVerifying node index... {checked} mapblocks checked, "
+                    f"{count} indexed.", end="")
+
+        if checked:
+            print()
+
+    def get_blocks(self, name):
+        """Returns a sorted list of (key, hash) for blocks using a node."""
+        if name not in self.name_ids:
+            return []
+
+        self.cursor.execute("SELECT n.pos, b.hash FROM nodeindex.nodes n "
+                "JOIN nodeindex.blocks b ON b.pos = n.pos "
+                "WHERE n.name_id = ? ORDER BY n.pos",
+                (self.name_ids[name],))
+        return self.cursor.fetchall()
@@ -0,0 +1,327 @@
+import multiprocessing
+import collections
+import hashlib
+import threading
+import queue
+import concurrent.futures
+from . import mapblock
+
+
+def transform_block(key, blob, transform, args):
+    """Parse a mapblock, apply a transform to it, and re-serialize it.
+
+    Returns the new mapblock data, or None if the transform did not
+    modify the mapblock.
+    """
+
+    block = mapblock.Mapblock(blob)
+    try:
+        return block.serialize() if transform(block, key, args) else None
+    except mapblock.MetadataSearchError:
+        return _transform_in_order(key, blob, transform, args)
+
+
+def _transform_in_order(key, blob, transform, args):
+    """Transform a mapblock whose node metadata was found in the wrong
+    place, parsing it in order instead.
+    """
+
+    block = mapblock.Mapblock(blob, searchMetadata=False)
+    return block.serialize() if transform(block, key, args) else None
+
+
+# Set in each worker process by _init_worker.
+_worker_transform = None
+_worker_args = None
+
+
+def _init_worker(transform, args):
+    global _worker_transform, _worker_args
+    _worker_transform = transform
+    _worker_args = args
+
+
+def _transform_batch(batch):
+    return [(key, transform_block(key, blob, _worker_transform, _worker_args))
+            for key, blob in batch]
+
+
+class TransformMemo:
+    """Cache of transform results for mapblocks with identical data.
+
+    Results are keyed by a hash of the input data and the value of
+    context(key, args), which must include everything about a block's
+    position that affects the transform. Blocks found in the cache are
+    not transformed again. The cache holds up to about maxBytes of
+    results, evicting the least recently used.
+    """
+
+    # Approximate memory used by each entry, besides the result itself.
+    ENTRY_SIZE = 200
+
+    def __init__(self, context, args, maxBytes):
+        self.context = context
+        self.args = args
+        self.max_bytes = maxBytes
+        self.results = collections.OrderedDict()
+        self.size = 0
+        # Cache keys of blocks which are being transformed.
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def split(self, batch):
+        """Split a batch of (key, blob) pairs into cached and new blocks.
+
+        Returns a list of (key, newData) pairs for cached blocks, and a
+        list of (key, blob) pairs for blocks which must be transformed.
+        """
+
+        found = []
+        missing = []
+
+        for key, blob in batch:
+            memoKey = (hashlib.blake2b(blob, digest_size=16).digest(),
+                    self.context(key, self.args))
+
+            if memoKey in self.results:
+                self.hits += 1
+                self.results.move_to_end(memoKey)
+                found.append((key, self.results[memoKey]))
+            else:
+                self.misses += 1
+                self.pending[key] = memoKey
+                missing.append((key, blob))
+
+        return found, missing
+
+    def add(self, results):
+        """Cache the (key, newData) results of blocks from split()."""
+        for key, data in results:
+            memoKey = self.pending.pop(key)
+            if memoKey in self.results:
+                continue
+
+            self.results[memoKey] = data
+            self.size += self.ENTRY_SIZE + (len(data) if data else 0)
+
+            while self.size > self.max_bytes:
+                oldKey, oldData = self.results.popitem(last=False)
+                self.size -= self.ENTRY_SIZE + (len(oldData) if oldData else 0)
+
+    def get_stats(self):
+        return (f"{self.hits} mapblocks deduplicated, "
+                f"{self.misses} transformed")
+
+
+def transform_serial(batches, transform, args, memo=None):
+    """Yields a list of (key, newData) pairs for each batch of mapblocks.
+
+    If memo is given, blocks found in it are not transformed again.
+    """
+
+    for batch in batches:
+        if memo:
+            (found, batch) = memo.split(batch)
+        else:
+            found = []
+
+        results = [(key, transform_block(key, blob, transform, args))
+                   for key, blob in batch]
+
+        if memo:
+            memo.add(results)
+        yield found + results
+
+
+def transform_parallel(batches, transform, args, jobs, memo=None):
+    """Yields a list of (key, newData) pairs for each batch of mapblocks.
+
+    Batches are transformed in worker processes, and results are yielded
+    in the same order as the input. Batches are read lazily, so only a
+    few batches per worker are held in memory at any time. The database
+    is only accessed from the calling process. If memo is given, blocks
+    found in it are not sent to the workers.
+    """
+
+    def get_results(found, result):
+        results = result.get() if result else []
+        if memo:
+            memo.add(results)
+        return found + results
+
+    with multiprocessing.Pool(jobs, initializer=_init_worker,
+            initargs=(transform, args)) as pool:
+        pending = collections.deque()
+
+        for batch in batches:
+            if memo:
+                (found, batch) = memo.split(batch)
+            else:
+                found = []
+
+            if batch:
+                pending.append((found,
+                        pool.apply_async(_transform_batch, (batch,))))
+            else:
+                pending.append((found, None))
+
+            if len(pending) >= jobs * 2:
+                yield get_results(*pending.popleft())
+
+        while pending:
+            yield get_results(*pending.popleft())
+
+
+# Blocks per task given to the thread pool.
+THREAD_CHUNK_SIZE = 64
+# Marks the end of the batches read by _read_batches.
+_END_OF_BATCHES = object()
+
+
+def _put_until_stopped(itemQueue, item, stop):
+    while not stop.is_set():
+        try:
+            itemQueue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _read_batches(batches, readQueue, stop, lock):
+    """Read batches into a queue until they run out or stop is set."""
+    try:
+        iterator = iter(batches)
+        while not stop.is_set():
+            with lock:
+                batch = next(iterator, None)
+            if batch == None:
+                break
+            _put_until_stopped(readQueue, batch, stop)
+    except BaseException as e:
+        _put_until_stopped(readQueue, e, stop)
+        return
+
+    _put_until_stopped(readQueue, _END_OF_BATCHES, stop)
+
+
+def _parse_blocks(chunk, readsNodeData):
+    blocks = []
+    for key, blob in chunk:
+        # If the node data is read anyway, decompress it now, while not
+        # holding the GIL. Parsing in order does so.
+        block = mapblock.Mapblock(blob, searchMetadata=not readsNodeData)
+        blocks.append((key, blob, block))
+    return blocks
+
+
+def _serialize_blocks(chunk):
+    """Serialize a chunk of (key, blob, block) tuples.
+
+    Returns a list of (key, newData) pairs, and a list of the positions
+    in it of blocks which must be transformed again, since their node
+    metadata was found in the wrong place. Those are (key, blob) pairs.
+    """
+
+    results = []
+    retries = []
+    for key, blob, block in chunk:
+        try:
+            results.append((key, block.serialize() if block else None))
+        except mapblock.MetadataSearchError:
+            retries.append(len(results))
+            results.append((key, blob))
+    return results, retries
+
+
+def _split_chunks(batch):
+    return [batch[i:i + THREAD_CHUNK_SIZE]
+            for i in range(0, len(batch), THREAD_CHUNK_SIZE)]
+
+
+def transform_threaded(batches, transform, args, threads, lock, memo=None,
+        readsNodeData=True):
+    """Yields a list of (key, newData) pairs for each batch of mapblocks.
+
+    A reader thread reads batches ahead into a bounded queue, holding
+    lock while reading. Mapblocks are parsed, decompressed, compressed
+    and serialized by a pool of threads, since zlib releases the GIL.
+    Node data is only decompressed ahead if readsNodeData is true, so
+    that it can still be copied as-is if the transform doesn't use it.
+    The transform itself is run in the calling thread. The caller must
+    hold lock while accessing the database, and must close the
+    generator if it stops early. If memo is given, blocks found in it
+    are not transformed again.
+    """
+
+    readQueue = queue.Queue(maxsize=threads * 2)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_batches,
+            args=(batches, readQueue, stop, lock), daemon=True)
+    # Batches being parsed and serialized, oldest first.
+    parsing = collections.deque()
+    serializing = collections.deque()
+
+    def transform_one(key, blob, block):
+        try:
+            return block if transform(block, key, args) else None
+        except mapblock.MetadataSearchError:
+            block = mapblock.Mapblock(blob, searchMetadata=False)
+            return block if transform(block, key, args) else None
+
+    def transform_batch(found, futures):
+        results = []
+        for future in futures:
+            chunk = [(key, blob, transform_one(key, blob, block))
+                     for key, blob, block in future.result()]
+            results.append(pool.submit(_serialize_blocks, chunk))
+        serializing.append((found, results))
+
+    def get_results(found, futures):
+        results = []
+        for future in futures:
+            (chunk, retries) = future.result()
+            for i in retries:
+                (key, blob) = chunk[i]
+                chunk[i] = (key, _transform_in_order(key, blob, transform,
+                        args))
+            results.extend(chunk)
+        if memo:
+            memo.add(results)
+        return found + results
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        reader.start()
+
+        try:
+            while True:
+                batch = readQueue.get()
+                if batch is _END_OF_BATCHES:
+                    break
+                elif isinstance(batch, BaseException):
+                    raise batch
+
+                if memo:
+                    (found, batch) = memo.split(batch)
+                else:
+                    found = []
+
+                parsing.append((found,
+                        [pool.submit(_parse_blocks, chunk, readsNodeData)
+                         for chunk in _split_chunks(batch)]))
+
+                if len(parsing) > 1:
+                    transform_batch(*parsing.popleft())
+                if len(serializing) > 1:
+                    yield get_results(*serializing.popleft())
+
+            while parsing:
+                transform_batch(*parsing.popleft())
+            while serializing:
+                yield get_results(*serializing.popleft())
+        finally:
+            stop.set()
+            reader.join()
+            for found, futures in parsing + serializing:
+                for future in futures:
+                    future.cancel()
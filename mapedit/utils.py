@@ -1,4 +1,7 @@
 import sqlite3
+import collections
+import functools
+import numpy as np
 from typing import NamedTuple
 import struct
 import math
@@ -75,6 +78,59 @@ class Vec3(NamedTuple):
             return NotImplemented
 
 
+class Vec3Array(NamedTuple):
+    """Arrays of 3D coordinates, to work on many positions at once."""
+    x: np.ndarray
+    y: np.ndarray
+    z: np.ndarray
+
+    @classmethod
+    def from_block_keys(cls, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        (keys, x) = np.divmod(keys + 0x800, 0x1000)
+        (z, y) = np.divmod(keys + 0x800, 0x1000)
+        return cls(x - 0x800, y - 0x800, z)
+
+    @classmethod
+    def from_u16_keys(cls, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        return cls(keys % 16,
+                   (keys >> 4) % 16,
+                   (keys >> 8) % 16)
+
+    def to_block_keys(self):
+        return (self.x * 0x1 +
+                self.y * 0x1000 +
+                self.z * 0x1000000)
+
+    def is_valid_block_pos(self):
+        """Returns a boolean array; see Vec3.is_valid_block_pos."""
+        limit = 31000 // 16
+        return ((np.abs(self.x) <= limit) &
+                (np.abs(self.y) <= limit) &
+                (np.abs(self.z) <= limit))
+
+    def __add__(self, other):
+        return Vec3Array(self.x + other.x,
+                         self.y + other.y,
+                         self.z + other.z)
+
+    def __sub__(self, other):
+        return Vec3Array(self.x - other.x,
+                         self.y - other.y,
+                         self.z - other.z)
+
+    def __mul__(self, other):
+        if type(other) in (Vec3, Vec3Array):
+            return Vec3Array(self.x * other.x,
+                             self.y * other.y,
+                             self.z * other.z)
+        elif type(other) == int:
+            return Vec3Array(*(n * other for n in self))
+        else:
+            return NotImplemented
+
+
 class Area(NamedTuple):
     """Area defined by two corner Vec3's.
 
@@ -101,9 +157,22 @@ class Area(NamedTuple):
                 self.p1.y <= pos.y <= self.p2.y and
                 self.p1.z <= pos.z <= self.p2.z)
 
+    def contains_many(self, positions):
+        """Returns a boolean array of which positions in a Vec3Array are
+        inside the area.
+        """
+
+        return ((self.p1.x <= positions.x) & (positions.x <= self.p2.x) &
+                (self.p1.y <= positions.y) & (positions.y <= self.p2.y) &
+                (self.p1.z <= positions.z) & (positions.z <= self.p2.z))
+
     def is_full_mapblock(self):
         return self.p1 == Vec3(0, 0, 0) and self.p2 == Vec3(15, 15, 15)
 
+    def __reduce__(self):
+        # Needed for pickling, since __iter__ doesn't yield the fields.
+        return (Area, (self.p1, self.p2))
+
     def __iter__(self):
         for x in range(self.p1.x, self.p2.x + 1):
             for y in range(self.p1.y, self.p2.y + 1):
@@ -121,8 +190,9 @@ def get_block_overlap(blockPos, area, relative=False):
     cornerPos = blockPos * 16
     relArea = area - cornerPos
     relOverlap = Area(
-        relArea.p1.map(lambda n: max(n, 0)),
-        relArea.p2.map(lambda n: min(n, 15))
+        Vec3(max(relArea.p1.x, 0), max(relArea.p1.y, 0), max(relArea.p1.z, 0)),
+        Vec3(min(relArea.p2.x, 15), min(relArea.p2.y, 15),
+             min(relArea.p2.z, 15))
     )
 
     if (relOverlap.p1.x > relOverlap.p2.x or
@@ -141,59 +211,366 @@ def get_overlap_slice(blockPos, area):
     return get_block_overlap(blockPos, area, relative=True).to_array_slices()
 
 
+# Number of masks kept by get_overlap_mask.
+OVERLAP_MASK_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=OVERLAP_MASK_CACHE_SIZE)
+def get_overlap_mask(overlap, invert=False):
+    """Returns a read-only boolean mask of the nodes in a mapblock which
+    are inside the relative overlap area, or outside it if invert is True.
+
+    Blocks along the edges of an area share the same few overlaps, so
+    masks are cached instead of being built for every block.
+    """
+
+    mask = np.full((16, 16, 16), invert, dtype="bool")
+    mask[overlap.to_array_slices()] = not invert
+    mask.flags.writeable = False
+    return mask
+
+
+def get_overlap_index(overlap, invert=False):
+    """Returns a NumPy index for the nodes in a mapblock which are inside
+    the relative overlap area, or outside it if invert is True.
+
+    Uses slices when possible, which are faster than a mask.
+    """
+
+    if invert:
+        return get_overlap_mask(overlap, invert=True)
+
+    return overlap.to_array_slices()
+
+
+# Maximum number of parameters in an SQL statement. SQLite versions before
+# 3.32.0 are limited to 999 by default.
+MAX_SQL_VARIABLES = 999
+
+
 class DatabaseHandler:
-    """Handles an SQLite database and provides useful methods."""
+    """Handles an SQLite database and provides useful methods.
+
+    Writes are buffered and executed in batches. The buffer is flushed
+    once it holds batchSize blocks or maxBufferBytes bytes of data, and
+    before committing. Reads with get_block see buffered writes.
+    """
 
-    def __init__(self, filename):
+    WRITE_BATCH_SIZE = 1000
+    WRITE_BUFFER_BYTES = 64 * 1024 * 1024
+
+    # PRAGMA settings used by each performance profile. "safe" keeps
+    # SQLite's defaults. The journal mode is restored when closing.
+    # Settings only apply to the main database, not attached ones.
+    PROFILES = {
+        "safe": {},
+        "fast": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -256 * 1024, # In KiB.
+            "mmap_size": 1024 ** 3,
+            "temp_store": "MEMORY",
+        },
+        "bulk": {
+            "journal_mode": "WAL",
+            "synchronous": "OFF",
+            "cache_size": -1024 * 1024,
+            "mmap_size": 4 * 1024 ** 3,
+            "temp_store": "MEMORY",
+        },
+    }
+
+    def __init__(self, filename, profile="safe", batchSize=WRITE_BATCH_SIZE,
+            maxBufferBytes=WRITE_BUFFER_BYTES):
         try:
             open(filename, 'r').close()
         except FileNotFoundError:
             raise
 
-        self.database = sqlite3.connect(filename)
+        # Reads may be done from another thread; see transform_threaded.
+        self.database = sqlite3.connect(filename, check_same_thread=False)
         self.cursor = self.database.cursor()
+        # Used by get_many and get_many_keys. Buffered writes are flushed
+        # on the same connection while it may still be reading, which
+        # SQLite only allows predictably for rows the read has already
+        # passed. Only write blocks from batches already yielded, and
+        # don't insert new rows into a table being read.
+        self.read_cursor = self.database.cursor()
+
+        self.batch_size = batchSize
+        self.max_buffer_bytes = maxBufferBytes
+        # Maps block keys to pending ("update"|"replace"|"delete", data).
+        self.pending = {}
+        self.pending_bytes = 0
+        # Blocks and bytes written since the last commit.
+        self.uncommitted_blocks = 0
+        self.uncommitted_bytes = 0
+        # NodeIndex kept up to date with all writes, if any.
+        self.node_index = None
 
         try:
-            self.cursor.execute("SELECT pos, data FROM blocks")
+            self.cursor.execute("SELECT pos, data FROM blocks LIMIT 0")
         except sqlite3.DatabaseError:
             raise
 
+        self.orig_journal_mode = self.get_pragma("journal_mode")
+        for name, value in self.PROFILES[profile].items():
+            self.set_pragma(name, value)
+
+    def get_pragma(self, name):
+        self.cursor.execute(f"PRAGMA main.{name}")
+        return self.cursor.fetchone()[0]
+
+    def set_pragma(self, name, value):
+        # Without a schema name, some settings such as journal_mode would
+        # also change attached databases.
+        self.cursor.execute(f"PRAGMA main.{name} = {value}")
+        self.cursor.fetchall()
+
     def is_modified(self):
-        return self.database.in_transaction
+        return self.database.in_transaction or bool(self.pending)
 
     def get_block(self, key):
+        if key in self.pending:
+            (op, data) = self.pending[key]
+
+            if op == "delete":
+                return None
+            elif op == "update":
+                # Updates only take effect if the block already exists.
+                self.cursor.execute("SELECT pos FROM blocks WHERE pos = ?",
+                        (key,))
+                return data if self.cursor.fetchone() else None
+            else:
+                return data
+
         self.cursor.execute("SELECT data FROM blocks WHERE pos = ?", (key,))
         if data := self.cursor.fetchone():
             return data[0]
         else:
             return None
 
-    def get_many(self, num):
-        return self.cursor.fetchmany(num)
+    def get_many(self, num, keyRanges=None, withData=True, ordered=False):
+        """Yields lists of up to num (key, data) rows.
+
+        If keyRanges is given, only rows with keys inside the given
+        (first, last) ranges are selected, using the primary key index.
+        If withData is false, data is None and only the index is read.
+        Rows are read in key order, except when reading data from the
+        whole table and ordered is false. Rows are read with a separate
+        cursor, so blocks may be written while iterating.
+        """
+
+        columns = "pos, data" if withData else "pos, NULL"
+
+        if keyRanges == None:
+            if ordered or not withData:
+                self.read_cursor.execute(
+                        f"SELECT {columns} FROM blocks ORDER BY pos")
+            else:
+                self.read_cursor.execute(f"SELECT {columns} FROM blocks")
+
+            while batch := self.read_cursor.fetchmany(num):
+                yield batch
+            return
+
+        batch = []
+        for first, last in keyRanges:
+            self.read_cursor.execute(
+                    f"SELECT {columns} FROM blocks WHERE pos BETWEEN ? AND ? "
+                    "ORDER BY pos",
+                    (first, last))
+
+            while rows := self.read_cursor.fetchmany(num - len(batch)):
+                batch.extend(rows)
+                if len(batch) >= num:
+                    yield batch
+                    batch = []
+
+        if batch:
+            yield batch
+
+    def get_many_keys(self, num, keys, withData=True):
+        """Yields lists of up to num (key, data) rows with the given keys.
+
+        keys must be sorted. Keys which do not exist are skipped.
+        """
+
+        columns = "pos, data" if withData else "pos, NULL"
+        num = min(num, MAX_SQL_VARIABLES)
+
+        for i in range(0, len(keys), num):
+            batchKeys = keys[i:i + num]
+            self.read_cursor.execute(f"SELECT {columns} FROM blocks "
+                    f"WHERE pos IN ({', '.join('?' * len(batchKeys))}) "
+                    "ORDER BY pos", batchKeys)
+
+            if batch := self.read_cursor.fetchall():
+                yield batch
+
+    def count_blocks(self, keyRanges=None):
+        if keyRanges == None:
+            self.read_cursor.execute("SELECT COUNT(*) FROM blocks")
+            return self.read_cursor.fetchone()[0]
+
+        count = 0
+        for first, last in keyRanges:
+            self.read_cursor.execute(
+                    "SELECT COUNT(*) FROM blocks WHERE pos BETWEEN ? AND ?",
+                    (first, last))
+            count += self.read_cursor.fetchone()[0]
+
+        return count
+
+    def _buffer_write(self, key, op, data):
+        if key in self.pending and self.pending[key][1]:
+            self.pending_bytes -= len(self.pending[key][1])
+
+        self.pending[key] = (op, data)
+        self.uncommitted_blocks += 1
+        if data:
+            self.pending_bytes += len(data)
+            self.uncommitted_bytes += len(data)
+
+        if (len(self.pending) >= self.batch_size
+                or self.pending_bytes >= self.max_buffer_bytes):
+            self.flush()
 
     def delete_block(self, key):
-        self.cursor.execute("DELETE FROM blocks WHERE pos = ?", (key,))
+        self._buffer_write(key, "delete", None)
 
     def set_block(self, key, data, force=False):
         # TODO: Remove force?
-        if force:
-            self.cursor.execute(
-                    "INSERT OR REPLACE INTO blocks (pos, data) VALUES (?, ?)",
-                    (key, data))
+        prevOp = self.pending[key][0] if key in self.pending else None
+
+        if force or prevOp == "replace":
+            self._buffer_write(key, "replace", data)
+        elif prevOp == "delete":
+            # The block no longer exists, so there is nothing to update.
+            pass
         else:
-            self.cursor.execute("UPDATE blocks SET data = ? WHERE pos = ?",
-                    (data, key))
+            self._buffer_write(key, "update", data)
+
+    def flush(self):
+        """Execute all buffered writes."""
+        deletes = []
+        updates = []
+        replaces = []
+
+        for key, (op, data) in self.pending.items():
+            if op == "delete":
+                deletes.append((key,))
+            elif op == "update":
+                updates.append((data, key))
+            else:
+                replaces.append((key, data))
+
+        if deletes:
+            self.cursor.executemany("DELETE FROM blocks WHERE pos = ?",
+                    deletes)
+        if updates:
+            self.cursor.executemany("UPDATE blocks SET data = ? WHERE pos = ?",
+                    updates)
+        if replaces:
+            self.cursor.executemany(
+                    "INSERT OR REPLACE INTO blocks (pos, data) VALUES (?, ?)",
+                    replaces)
+
+        if self.node_index:
+            self.node_index.remove_ranges([(key, key) for key, in deletes])
+            self.node_index.update_blocks([(key, data)
+                    for data, key in updates] + replaces)
+
+        self.pending.clear()
+        self.pending_bytes = 0
+
+    def get_job(self):
+        """Returns the saved (command, args, lastKey, checksum), or None."""
+        try:
+            self.cursor.execute(
+                    "SELECT command, args, last_key, checksum FROM mapedit_job")
+        except sqlite3.OperationalError:
+            # No job has been saved.
+            return None
+
+        return self.cursor.fetchone()
+
+    def set_job(self, command, args, lastKey, checksum):
+        """Save the state of a job, to be committed with its changes."""
+        self.flush()
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS mapedit_job "
+                "(command TEXT, args TEXT, last_key INTEGER, checksum TEXT)")
+        self.cursor.execute("DELETE FROM mapedit_job")
+        self.cursor.execute("INSERT INTO mapedit_job VALUES (?, ?, ?, ?)",
+                (command, args, lastKey, checksum))
+
+    def delete_job(self):
+        self.flush()
+        self.cursor.execute("DROP TABLE IF EXISTS mapedit_job")
+
+    def delete_ranges(self, keyRanges):
+        """Delete all blocks in the given (first, last) key ranges."""
+        self.flush()
+        self.cursor.executemany(
+                "DELETE FROM blocks WHERE pos BETWEEN ? AND ?", keyRanges)
+        self.uncommitted_blocks += max(self.cursor.rowcount, 0)
+
+        if self.node_index:
+            self.node_index.remove_ranges(keyRanges)
+
+    def attach(self, filename, name):
+        """Attach another database so it can be used in queries."""
+        self.cursor.execute(f"ATTACH DATABASE ? AS {name}", (filename,))
+
+    def copy_blocks(self, keys, offsetKey, source, condition="1"):
+        """Copy blocks from an attached database without reading them.
+
+        Each block is copied to its key plus offsetKey, replacing any
+        existing block. Only blocks matching the SQL condition are
+        copied. All blocks are copied by a single statement, so keys may
+        contain at most MAX_SQL_VARIABLES - 1 keys. Returns the number of
+        blocks copied.
+        """
+
+        self.flush()
+        self.cursor.execute("INSERT OR REPLACE INTO blocks (pos, data) "
+                f"SELECT pos + ?, data FROM {source}.blocks "
+                f"WHERE pos IN ({', '.join('?' * len(keys))}) "
+                f"AND {condition}",
+                (offsetKey, *keys))
+
+        count = self.cursor.rowcount
+        self.uncommitted_blocks += count
+
+        if self.node_index:
+            # The copied blocks are indexed by the next sync.
+            self.node_index.remove_ranges([(key + offsetKey, key + offsetKey)
+                    for key in keys])
+
+        return count
 
     def vacuum(self):
         self.commit() # In case the database has been modified.
         self.cursor.execute("VACUUM")
 
     def commit(self):
+        self.flush()
         if self.is_modified():
             self.database.commit()
 
+        self.uncommitted_blocks = 0
+        self.uncommitted_bytes = 0
+
     def close(self):
-        self.database.close()
+        try:
+            self.read_cursor.close()
+
+            if self.get_pragma("journal_mode") != self.orig_journal_mode:
+                # Discard uncommitted changes, as closing would.
+                self.database.rollback()
+                self.set_pragma("journal_mode", self.orig_journal_mode)
+        finally:
+            self.database.close()
 
 
 def get_mapblock_area(area, invert=False, includePartial=False):
@@ -213,38 +590,306 @@ def get_mapblock_area(area, invert=False, includePartial=False):
                     area.p2.map(lambda n: n // 16))
 
 
-def get_mapblocks(database, searchData=None, area=None, invert=False,
-        includePartial=False):
-    """Returns a list of all mapblocks that fit the given criteria."""
-    keys = []
+# Limits of block positions which can be stored in a mapblock key.
+MIN_BLOCK_POS = Vec3(-2048, -2048, -2048)
+MAX_BLOCK_POS = Vec3(2047, 2047, 2047)
+# Above this many key ranges, scanning the whole table is faster.
+MAX_KEY_RANGES = 100000
+
 
-    if area:
-        blockArea = get_mapblock_area(area, invert=invert,
-                includePartial=includePartial)
+def get_block_key_ranges(blockArea, invert=False):
+    """Get sorted (first, last) ranges of mapblock keys inside an area.
+
+    Each row of blocks along the X axis has consecutive keys, so an area
+    is covered by one range per (y, z) row. Adjacent rows are merged.
+    If invert is true, the ranges cover every key outside the area.
+    Returns None if there are too many ranges to be worth querying.
+    """
+
+    p1 = Vec3(*(max(n, m) for n, m in zip(blockArea.p1, MIN_BLOCK_POS)))
+    p2 = Vec3(*(min(n, m) for n, m in zip(blockArea.p2, MAX_BLOCK_POS)))
+
+    if p1.x > p2.x or p1.y > p2.y or p1.z > p2.z:
+        # Area is empty.
+        ranges = []
+    elif (p2.y - p1.y + 1) * (p2.z - p1.z + 1) > MAX_KEY_RANGES:
+        return None
     else:
-        blockArea = None
-
-    while True:
-        batch = database.get_many(1000)
-        # Exit if we run out of database entries.
-        if len(batch) == 0:
-            break
-
-        for key, data in batch:
-            # Make sure the block is inside/outside the area as specified.
-            if (blockArea and
-                    blockArea.contains(Vec3.from_block_key(key)) == invert):
-                continue
+        ranges = []
+        for z in range(p1.z, p2.z + 1):
+            for y in range(p1.y, p2.y + 1):
+                first = Vec3(p1.x, y, z).to_block_key()
+                last = Vec3(p2.x, y, z).to_block_key()
+
+                if ranges and ranges[-1][1] + 1 == first:
+                    ranges[-1] = (ranges[-1][0], last)
+                else:
+                    ranges.append((first, last))
+
+    if not invert:
+        return ranges
+
+    inverted = []
+    nextKey = MIN_BLOCK_POS.to_block_key()
+
+    for first, last in ranges:
+        if first > nextKey:
+            inverted.append((nextKey, first - 1))
+        nextKey = last + 1
+
+    if nextKey <= MAX_BLOCK_POS.to_block_key():
+        inverted.append((nextKey, MAX_BLOCK_POS.to_block_key()))
+
+    return inverted
+
+
+class BlockSelection:
+    """Mapblocks selected by area and/or a string to search for.
+
+    searchData selects blocks containing a string anywhere in their raw
+    data. searchNode selects blocks whose name-id map includes a node.
+    searchNodes is a list of nodes; blocks are only filtered by it when
+    a node index is used, so the caller must check the name-id maps.
+
+    Iterating over a selection reads the matching rows in one pass and
+    yields them as lists of (key, data) pairs. Lists may be empty if no
+    rows in a batch matched. The keys of all rows read in each batch,
+    matching or not, are appended to batch_keys.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, database, searchData=None, area=None, invert=False,
+            includePartial=False, withData=True, searchNode=None,
+            searchNodes=None):
+        self.database = database
+        self.invert = invert
+
+        if searchNode:
+            searchNodes = [searchNode]
+        elif searchNodes and len(searchNodes) == 1:
+            searchNode = searchNodes[0]
+
+        if searchNode:
+            # Match the length-prefixed name in the name-id map, so that
+            # names which only contain the search node are not matched.
+            self.search_data = struct.pack(">H", len(searchNode)) + searchNode
+        else:
+            self.search_data = searchData
+
+        self.with_data = withData or bool(self.search_data)
+        self.ordered = False
+        # Number of rows read from the database so far.
+        self.scanned = 0
+        self.batch_keys = collections.deque()
+
+        if area:
+            self.block_area = get_mapblock_area(area, invert=invert,
+                    includePartial=includePartial)
+            self.key_ranges = get_block_key_ranges(self.block_area,
+                    invert=invert)
+        else:
+            self.block_area = None
+            self.key_ranges = None
+
+        # If a node index is available, only the blocks which use the
+        # node are read, instead of the whole area.
+        self.candidates = None
+        self.candidate_hashes = None
+        # Nodes to look up in the index when the selection is first used.
+        if searchNodes and database.node_index:
+            self.index_nodes = searchNodes
+        else:
+            self.index_nodes = None
+
+    def _find_candidates(self):
+        """Look up the blocks which use the search nodes in the node index.
+
+        This is done once the selection is used, so that selections which
+        are never read, such as those of commands in a batch script, don't
+        sync the index.
+        """
+
+        if self.index_nodes == None:
+            return
+
+        nodeIndex = self.database.node_index
+        # Blocks outside the selected key ranges are never read, so they
+        # don't need to be checked.
+        nodeIndex.sync(self.key_ranges)
+        self.candidate_hashes = {}
+        for name in self.index_nodes:
+            self.candidate_hashes.update(nodeIndex.get_blocks(name))
+        self.index_nodes = None
+
+        candidates = np.array(sorted(self.candidate_hashes), dtype=np.int64)
+        if self.block_area:
+            candidates = candidates[self.block_area.contains_many(
+                    Vec3Array.from_block_keys(candidates)) != self.invert]
+        self.candidates = candidates.tolist()
+
+    def start_after(self, key):
+        """Read rows in key order, skipping keys up to the given key.
+
+        If key is None, no rows are skipped.
+        """
+
+        self._find_candidates()
+        self.ordered = True
+        if key == None:
+            return
+
+        if self.candidates != None:
+            self.candidates = [k for k in self.candidates if k > key]
+        elif self.key_ranges == None:
+            self.key_ranges = [(key + 1, MAX_BLOCK_POS.to_block_key())]
+        else:
+            self.key_ranges = [(max(first, key + 1), last)
+                               for first, last in self.key_ranges
+                               if last > key]
+
+    def get_row_ranges(self, keys):
+        """Split sorted selected keys into ranges of selected rows.
+
+        Every row inside the returned (first, last) ranges is selected,
+        so the ranges can be used to modify the rows directly.
+        """
+
+        if self.key_ranges == None or self.search_data:
+            # Rows are filtered one by one.
+            return [(key, key) for key in keys]
+
+        ranges = []
+        rangeIdx = 0
+
+        for key in keys:
+            # Find the selected key range which contains the key.
+            while self.key_ranges[rangeIdx][1] < key:
+                rangeIdx += 1
+
+            if ranges and ranges[-1][2] == rangeIdx:
+                ranges[-1][1] = key
+            else:
+                ranges.append([key, key, rangeIdx])
+
+        return [(first, last) for first, last, idx in ranges]
+
+    def count(self):
+        """Returns the number of rows which will be read."""
+        self._find_candidates()
+        if self.candidates != None:
+            return len(self.candidates)
+
+        return self.database.count_blocks(self.key_ranges)
+
+    def get_checksum(self):
+        """Returns a KeyChecksum of the rows which will be read."""
+        self._find_candidates()
+        if self.candidates != None:
+            return KeyChecksum(self.candidates)
+
+        checksum = KeyChecksum()
+
+        for batch in self.database.get_many(self.BATCH_SIZE,
+                keyRanges=self.key_ranges, withData=False):
+            checksum.add_all(key for key, data in batch)
+
+        return checksum
+
+    def __iter__(self):
+        self._find_candidates()
+        if self.candidates != None:
+            batches = self.database.get_many_keys(self.BATCH_SIZE,
+                    self.candidates, withData=self.with_data)
+        else:
+            batches = self.database.get_many(self.BATCH_SIZE,
+                    keyRanges=self.key_ranges, withData=self.with_data,
+                    ordered=self.ordered)
+
+        for batch in batches:
+            self.scanned += len(batch)
+            keys = [key for key, data in batch]
+            self.batch_keys.append(keys)
+
+            if self.candidate_hashes != None:
+                self.database.node_index.check_blocks(batch,
+                        self.candidate_hashes)
+
+            # Make sure the blocks are inside/outside the area as specified.
+            if self.block_area and batch:
+                inArea = self.block_area.contains_many(
+                        Vec3Array.from_block_keys(keys))
+                batch = [row for row, isIn in zip(batch, inArea)
+                         if isIn != self.invert]
+
             # Specifies a node name or other string to search for.
-            if searchData and data.find(searchData) == -1:
-                continue
-            # If checks pass, add the key to the list.
-            keys.append(key)
+            if self.search_data:
+                batch = [(key, data) for key, data in batch
+                         if data.find(self.search_data) != -1]
+
+            yield batch
+
+
+def get_mapblocks(database, searchData=None, area=None, invert=False,
+        includePartial=False):
+    """Returns an array of the keys of all mapblocks that fit the given
+    criteria, in ascending order.
+    """
+
+    chunks = []
+    count = 0
 
-        print(f"\rBuilding index... {len(keys)} mapblocks found.", end="")
+    for batch in BlockSelection(database, searchData=searchData, area=area,
+            invert=invert, includePartial=includePartial, withData=False):
+        chunks.append(np.fromiter((key for key, data in batch),
+                dtype=np.int64, count=len(batch)))
+        count += len(batch)
+        print(f"\rBuilding index... {count} mapblocks found.", end="")
 
     print()
-    return keys
+
+    if not chunks:
+        return np.empty(0, dtype=np.int64)
+
+    return np.sort(np.concatenate(chunks))
+
+
+class KeyChecksum:
+    """Checksum of a set of mapblock keys.
+
+    Keys can be added and removed in any order, so the checksum of the
+    blocks left to process in a job can be kept up to date cheaply.
+    """
+
+    MASK = 0xFFFFFFFFFFFFFFFF
+
+    def __init__(self, keys=()):
+        self.count = 0
+        self.total = 0
+        self.squares = 0
+        self.add_all(keys)
+
+    def add_all(self, keys, sign=1):
+        if isinstance(keys, np.ndarray):
+            # Unsigned 64-bit arithmetic wraps around like MASK.
+            keys = keys.astype(np.uint64)
+            total = int(keys.sum(dtype=np.uint64))
+            squares = int((keys * keys).sum(dtype=np.uint64))
+            self.count += sign * len(keys)
+            self.total = (self.total + sign * total) & self.MASK
+            self.squares = (self.squares + sign * squares) & self.MASK
+            return
+
+        for key in keys:
+            self.count += sign
+            self.total = (self.total + sign * key) & self.MASK
+            self.squares = (self.squares + sign * key * key) & self.MASK
+
+    def remove_all(self, keys):
+        self.add_all(keys, sign=-1)
+
+    def __str__(self):
+        return f"{self.count}:{self.total:016x}:{self.squares:016x}"
 
 
 class Progress:
@@ -254,6 +899,7 @@ class Progress:
 
     def __init__(self):
         self.start_time = None
+        self.last_completed = 0
         self.last_total = 0
         self.last_time = 0
 
@@ -276,15 +922,17 @@ class Progress:
         self.start_time = time.time()
 
     def update_bar(self, completed, total):
+        self.last_completed = completed
         self.last_total = total
         timeNow = time.time()
 
         if timeNow - self.last_time > self.PRINT_INTERVAL:
             self._print_bar(completed, total, timeNow)
 
-    def update_final(self):
+    def update_final(self, finished=True):
         if self.start_time:
-            self._print_bar(self.last_total, self.last_total, time.time())
+            completed = self.last_total if finished else self.last_completed
+            self._print_bar(completed, self.last_total, time.time())
             print()
 
 
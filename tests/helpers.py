@@ -0,0 +1,84 @@
+import numpy as np
+import sqlite3
+import struct
+import zlib
+
+
+def make_node_data(nodeData=None, param1=None, param2=None):
+    """Returns raw node data from 16x16x16 arrays, which default to 0."""
+    if nodeData is None:
+        nodeData = np.zeros((16, 16, 16), dtype=">u2")
+    if param1 is None:
+        param1 = np.zeros((16, 16, 16), dtype="u1")
+    if param2 is None:
+        param2 = np.zeros((16, 16, 16), dtype="u1")
+
+    return (nodeData.astype(">u2").tobytes() +
+            param1.astype("u1").tobytes() +
+            param2.astype("u1").tobytes())
+
+
+def make_metadata(metaList):
+    """Returns raw version 2 node metadata for a list of (pos, vars, inv).
+
+    vars is a dict of {name: value} byte strings.
+    """
+
+    if not metaList:
+        return b"\x00"
+
+    blob = struct.pack(">BH", 2, len(metaList))
+
+    for pos, metaVars, inv in metaList:
+        blob += struct.pack(">HI", pos, len(metaVars))
+        for name, value in metaVars.items():
+            blob += struct.pack(">H", len(name)) + name
+            blob += struct.pack(">I", len(value)) + value + b"\x00"
+        blob += inv
+
+    return blob
+
+
+def make_object(name, data=b""):
+    """Returns static object data for an object with a name."""
+    return (b"\x00" + struct.pack(">H", len(name)) + name +
+            struct.pack(">I", len(data)) + data)
+
+
+def make_block(nimap, nodeData=None, param1=None, param2=None,
+        metadata=b"\x00", timers=(), level=-1, objects=()):
+    """Returns the data of a version 28 mapblock.
+
+    nimap is a list of node names. timers is a list of
+    (pos, timeout, elapsed) tuples. objects is a list of static object
+    data, placed at the origin. level is the zlib compression level.
+    """
+
+    blob = struct.pack(">BB2sBB", 28, 0x00, b"\xff\xff", 2, 2)
+    blob += zlib.compress(make_node_data(nodeData, param1, param2), level)
+    blob += zlib.compress(metadata, level)
+    blob += struct.pack(">BH", 0, len(objects))
+    for data in objects:
+        blob += struct.pack(">B12sH", 7, bytes(12), len(data)) + data
+    # Timestamp 0.
+    blob += struct.pack(">I", 0)
+
+    blob += struct.pack(">BH", 0, len(nimap))
+    for nid, name in enumerate(nimap):
+        blob += struct.pack(">HH", nid, len(name)) + name
+
+    blob += struct.pack(">BH", 10, len(timers))
+    for timer in timers:
+        blob += struct.pack(">HII", *timer)
+
+    return blob
+
+
+def make_map_file(filename, blocks=()):
+    """Create a map database containing a list of (key, data) blocks."""
+    database = sqlite3.connect(filename)
+    database.execute("CREATE TABLE blocks "
+            "(pos INT PRIMARY KEY NOT NULL, data BLOB)")
+    database.executemany("INSERT INTO blocks VALUES (?, ?)", blocks)
+    database.commit()
+    database.close()
@@ -0,0 +1,108 @@
+import numpy as np
+from mapedit import blockfuncs, utils
+
+NAMES = [b"air", b"default:stone", b"default:dirt", b"default:sand",
+        b"default:water_source"]
+
+
+def old_clean_nimap(nimap, nodeData):
+    """The original clean_nimap loop, used as a reference."""
+    for nid, name in utils.SafeEnum(nimap):
+        delete = False
+        firstOccur = nimap.index(name)
+        if firstOccur < nid:
+            nodeData[nodeData == nid] = firstOccur
+            delete = True
+        if delete or np.all(nodeData != nid):
+            del nimap[nid]
+            nodeData[nodeData > nid] -= 1
+
+
+def old_remap_nodes(nimap, nodeData, mapping):
+    """Replaces nodes in a whole mapblock the original way."""
+    lookup = np.arange(max(len(nimap), int(nodeData.max()) + 1))
+
+    for nid, name in enumerate(nimap[:]):
+        if name in mapping:
+            if mapping[name] not in nimap:
+                nimap.append(mapping[name])
+            lookup[nid] = nimap.index(mapping[name])
+
+    nodeData[...] = lookup[nodeData]
+    old_clean_nimap(nimap, nodeData)
+
+
+def node_names(nimap, nodeData):
+    """Returns the name of each node, or its id if it has no name."""
+    return [nimap[nid] if nid < len(nimap) else nid
+            for nid in nodeData.ravel().tolist()]
+
+
+def random_nimaps(rng, count, extraIds=0):
+    """Yields nimaps with duplicate names, along with node data which
+    leaves some ids unused. Up to extraIds ids past the end of the nimap
+    may also be used.
+    """
+
+    for i in range(count):
+        nimap = [bytes(name) for name in
+                rng.choice(NAMES, int(rng.integers(1, 9)))]
+        usedIds = rng.choice(len(nimap) + extraIds, int(rng.integers(1, 5)))
+        nodeData = rng.choice(usedIds, (16, 16, 16)).astype(">u2")
+        yield nimap, nodeData
+
+
+def test_clean_nimap_matches_old_loop():
+    rng = np.random.default_rng(0)
+
+    for nimap, nodeData in random_nimaps(rng, 500, extraIds=2):
+        expectedNimap = nimap[:]
+        expectedData = nodeData.copy()
+        old_clean_nimap(expectedNimap, expectedData)
+
+        blockfuncs.clean_nimap(nimap, nodeData)
+        assert nimap == expectedNimap
+        assert np.array_equal(nodeData, expectedData)
+
+
+def test_clean_nimap_unused_and_duplicates():
+    nimap = [b"air", b"default:stone", b"air", b"default:dirt",
+            b"default:stone"]
+    nodeData = np.array([4, 2, 4, 3, 5], dtype=">u2")
+
+    blockfuncs.clean_nimap(nimap, nodeData)
+    assert nimap == [b"air", b"default:stone", b"default:dirt"]
+    assert nodeData.tolist() == [1, 0, 1, 2, 3]
+
+
+def test_remap_nodes_matches_old_loop():
+    rng = np.random.default_rng(1)
+
+    for nimap, nodeData in random_nimaps(rng, 500):
+        mapping = {bytes(name): bytes(rng.choice(NAMES)) for name in
+                rng.choice(NAMES, int(rng.integers(1, 4)), replace=False)}
+        mapping = {k: v for k, v in mapping.items() if k != v}
+        if not any(name in mapping for name in nimap):
+            continue
+
+        numDuplicates = len(nimap) - len(set(nimap))
+        expectedNimap = nimap[:]
+        expectedData = nodeData.copy()
+        old_remap_nodes(expectedNimap, expectedData, mapping)
+
+        assert blockfuncs.remap_nodes(nimap, nodeData, mapping)
+        # Names may be in a different order, but each node must get
+        # the same name.
+        assert (node_names(nimap, nodeData)
+                == node_names(expectedNimap, expectedData))
+        # Replacing nodes doesn't add duplicate names.
+        assert len(nimap) - len(set(nimap)) <= numDuplicates
+
+
+def test_get_remap_ids_keeps_unreplaced_order():
+    nimap = [b"default:stone", b"air", b"default:dirt", b"default:stone"]
+    mapping = {b"default:stone": b"default:dirt"}
+
+    (newNimap, newIds) = blockfuncs.get_remap_ids(nimap, mapping)
+    assert newNimap == [b"air", b"default:dirt"]
+    assert newIds == [1, 0, 1, 1]
@@ -0,0 +1,174 @@
+import shutil
+import sqlite3
+import sys
+import numpy as np
+import pytest
+from mapedit import cmdline, utils
+from tests.helpers import make_block, make_map_file
+
+
+def run_mapedit(monkeypatch, mapFile, *args):
+    monkeypatch.setattr(sys, "argv",
+            ["mapedit", "-f", mapFile, "--no-warnings"] + list(args))
+    cmdline.run_cmdline()
+
+
+def get_job(mapFile):
+    database = sqlite3.connect(mapFile)
+    if database.execute("SELECT COUNT(*) FROM sqlite_master "
+            "WHERE name = 'mapedit_job'").fetchone()[0]:
+        job = database.execute("SELECT * FROM mapedit_job").fetchone()
+    else:
+        job = None
+    database.close()
+    return job
+
+
+def get_blocks(mapFile):
+    database = sqlite3.connect(mapFile)
+    blocks = dict(database.execute("SELECT pos, data FROM blocks"))
+    database.close()
+    return blocks
+
+
+def make_test_map(mapFile):
+    """Create a map of 5x3x5 mapblocks around the origin, each different."""
+    blocks = []
+    for x in range(-2, 3):
+        for y in range(-1, 2):
+            for z in range(-2, 3):
+                key = utils.Vec3(x, y, z).to_block_key()
+                nodeData = np.arange(4096).reshape((16, 16, 16)) % 2
+                param1 = np.full((16, 16, 16), key % 256)
+                nimap = ([b"air", b"default:stone"] if (x + y + z) % 2
+                        else [b"air", b"default:dirt"])
+                blocks.append((key, make_block(nimap, nodeData=nodeData,
+                        param1=param1)))
+
+    make_map_file(mapFile, blocks)
+
+
+def interrupt_after_writes(monkeypatch, count):
+    """Raise KeyboardInterrupt when writing more than count blocks.
+
+    Returns the list of written keys, which may be cleared to start
+    counting again.
+    """
+    written = []
+    setBlock = utils.DatabaseHandler.set_block
+
+    def set_block(self, key, data, force=False):
+        if len(written) >= count:
+            raise KeyboardInterrupt()
+        written.append(key)
+        setBlock(self, key, data, force)
+
+    monkeypatch.setattr(utils.DatabaseHandler, "set_block", set_block)
+    return written
+
+
+def test_commit_every_commits_within_batch(tmp_path, monkeypatch):
+    mapFile = str(tmp_path / "map.sqlite")
+    make_map_file(mapFile, [(key, make_block([b"default:stone"]))
+                            for key in range(245)])
+
+    interrupt_after_writes(monkeypatch, 32)
+    with pytest.raises(KeyboardInterrupt):
+        run_mapedit(monkeypatch, mapFile, "--commit-every", "5",
+                "setparam2", "--searchnode", "default:stone", "7")
+
+    # The first 30 blocks were committed, in chunks of 5.
+    assert get_job(mapFile)[2] == 29
+    database = sqlite3.connect(mapFile)
+    changed = [key for key, data in database.execute(
+            "SELECT pos, data FROM blocks ORDER BY pos")
+            if data != make_block([b"default:stone"])]
+    database.close()
+    assert changed == list(range(30))
+
+
+AREA = ["--p1", "-20", "-10", "-20", "--p2", "30", "17", "5"]
+
+SEARCH_COMMANDS = [
+    ["setparam2", "--searchnode", "default:stone", "7"],
+    ["setparam2"] + AREA + ["--invert", "--searchnode", "default:dirt", "9"],
+]
+TRANSFORM_COMMANDS = [
+    ["fill"] + AREA + ["--invert", "default:cobble"],
+] + SEARCH_COMMANDS
+CLONE_COMMANDS = [
+    ["clone"] + AREA + ["--offset", "7", "-3", "20"],
+    ["clone"] + AREA + ["--offset", "-7", "3", "-20"],
+]
+
+
+@pytest.mark.parametrize("command, extraArgs",
+        [(command, []) for command in TRANSFORM_COMMANDS + CLONE_COMMANDS] +
+        [(command, ["--memo", "1"]) for command in TRANSFORM_COMMANDS] +
+        [(command, ["--node-index"]) for command in SEARCH_COMMANDS])
+def test_resume_matches_uninterrupted(tmp_path, monkeypatch, command,
+        extraArgs):
+    mapFile = str(tmp_path / "map.sqlite")
+    expectedFile = str(tmp_path / "expected.sqlite")
+    make_test_map(mapFile)
+    shutil.copy(mapFile, expectedFile)
+    run_mapedit(monkeypatch, expectedFile, *command)
+
+    # Several batches per command, and several chunks per batch.
+    monkeypatch.setattr(utils.BlockSelection, "BATCH_SIZE", 7)
+    written = interrupt_after_writes(monkeypatch, 5)
+    globalArgs = extraArgs + ["--commit-every", "3"]
+    args = globalArgs + command
+    runs = 0
+
+    while True:
+        # Each run commits one chunk, then stops part way into the next.
+        written.clear()
+        try:
+            run_mapedit(monkeypatch, mapFile, *args)
+            break
+        except KeyboardInterrupt:
+            assert get_job(mapFile) != None
+        args = globalArgs + ["resume"]
+        runs += 1
+        assert runs < 100
+
+    assert runs > 1
+    assert get_job(mapFile) == None
+    assert get_blocks(mapFile) == get_blocks(expectedFile)
+
+
+@pytest.mark.parametrize("change", ["add", "remove"])
+def test_resume_refuses_changed_selection(tmp_path, monkeypatch, capsys,
+        change):
+    mapFile = str(tmp_path / "map.sqlite")
+    make_test_map(mapFile)
+    monkeypatch.setattr(utils.BlockSelection, "BATCH_SIZE", 7)
+    setBlock = utils.DatabaseHandler.set_block
+
+    interrupt_after_writes(monkeypatch, 5)
+    with pytest.raises(KeyboardInterrupt):
+        run_mapedit(monkeypatch, mapFile, "--commit-every", "3",
+                "setparam2", "--searchnode", "default:stone", "7")
+    monkeypatch.setattr(utils.DatabaseHandler, "set_block", setBlock)
+
+    job = get_job(mapFile)
+    # Change a block with stone which has not been processed yet.
+    key = utils.Vec3(2, 1, 2).to_block_key()
+    assert key > job[2]
+    database = sqlite3.connect(mapFile)
+    if change == "add":
+        database.execute("INSERT INTO blocks VALUES (?, ?)",
+                (key + 1, make_block([b"default:stone"])))
+    else:
+        database.execute("DELETE FROM blocks WHERE pos = ?", (key,))
+    database.commit()
+    database.close()
+    blocks = get_blocks(mapFile)
+
+    capsys.readouterr()
+    run_mapedit(monkeypatch, mapFile, "resume")
+    assert ("Mapblocks have been added or removed since the job was "
+            "interrupted." in capsys.readouterr().out)
+    assert get_job(mapFile) == job
+    assert get_blocks(mapFile) == blocks
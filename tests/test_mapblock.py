@@ -0,0 +1,125 @@
+import argparse
+import struct
+import threading
+import zlib
+import numpy as np
+from mapedit import mapblock, commands, pipeline
+from tests.helpers import make_block, make_metadata, make_object
+
+
+def decompress_sequential(blob):
+    """Returns (node data, metadata) by decompressing both streams in order."""
+    decompresser = zlib.decompressobj()
+    nodeData = decompresser.decompress(blob[6:])
+    decompresser2 = zlib.decompressobj()
+    metadata = decompresser2.decompress(decompresser.unused_data)
+    return nodeData, metadata
+
+
+def check_block(blob, metadata):
+    block = mapblock.Mapblock(blob)
+    assert block.node_metadata == metadata
+    assert decompress_sequential(blob) == (block.node_data_raw, metadata)
+    assert block.serialize() == blob
+
+
+def test_find_metadata_nested_zlib_stream():
+    # With no compression, a complete zlib stream stored in a metadata
+    # value appears as-is inside the metadata stream, after its header.
+    inner = zlib.compress(b"\x00")
+    metadata = make_metadata([(0, {b"a": inner, b"b": inner + b"\x00"},
+            b"EndInventory\n")])
+    nodeData = np.arange(4096, dtype=">u2").reshape((16, 16, 16)) % 3
+    blob = make_block([b"air", b"default:stone", b"default:dirt"],
+            nodeData=nodeData, metadata=metadata,
+            timers=[(5, 1000, 0)], level=0)
+
+    assert blob.rfind(inner) > blob.find(inner) > 6
+    check_block(blob, metadata)
+
+
+def test_find_metadata_header_like_bytes():
+    rng = np.random.default_rng(0)
+    headerCount = 0
+
+    for i in range(50):
+        # Random values compress poorly, leaving bytes in the compressed
+        # metadata which look like a zlib header.
+        metaList = [(int(pos), {b"v": rng.bytes(int(rng.integers(1, 200)))},
+                b"EndInventory\n")
+                for pos in rng.choice(4096, int(rng.integers(1, 6)),
+                replace=False)]
+        metadata = make_metadata(metaList)
+        param1 = rng.integers(0, 256, (16, 16, 16))
+        blob = make_block([b"air", b"default:chest"], param1=param1,
+                metadata=metadata)
+
+        compressed = zlib.compress(metadata)
+        headerCount += sum(1 for p in range(1, len(compressed) - 1)
+                if compressed[p] == 0x78
+                and (compressed[p] << 8 | compressed[p+1]) % 31 == 0)
+
+        check_block(blob, metadata)
+
+    assert headerCount > 0
+
+
+def make_false_tail_block():
+    """Returns a mapblock in which a zlib stream stored in the metadata
+    is followed by bytes which parse as the rest of the mapblock.
+
+    Both the real and the false static objects contain an entity.
+    """
+
+    inner = zlib.compress(b"x")
+    entity = make_object(b"mobs:sheep")
+    nimap = [b"air", b"default:chest"]
+
+    def build(nameLen):
+        # A static object, then a name which runs over the rest of the
+        # real data until the real node timers.
+        falseTail = (struct.pack(">BH", 0, 1) +
+                struct.pack(">B12sH", 7, bytes(12), len(entity)) + entity +
+                struct.pack(">IBH", 0, 0, 1) + struct.pack(">HH", 0, nameLen))
+        metadata = make_metadata([(0, {b"v": inner + falseTail},
+                b"EndInventory\n")])
+        blob = make_block(nimap, metadata=metadata, level=0,
+                objects=[entity])
+        return blob, metadata, blob.index(falseTail) + len(falseTail)
+
+    (blob, metadata, nameStart) = build(0)
+    # The node timers are the last 3 bytes.
+    (blob, metadata, nameStart) = build(len(blob) - 3 - nameStart)
+    return blob, metadata
+
+
+def test_false_tail_is_accepted():
+    (blob, metadata) = make_false_tail_block()
+
+    # The search finds the stored stream, so the test block is crafted
+    # correctly.
+    assert mapblock.Mapblock(blob).node_metadata == b"x"
+    block = mapblock.Mapblock(blob, searchMetadata=False)
+    assert block.node_metadata == metadata
+    assert block.serialize() == blob
+
+
+def test_false_tail_delete_objects():
+    (blob, metadata) = make_false_tail_block()
+    args = argparse.Namespace(searchobj_b=b"mobs:sheep", area=None,
+            invert=False, items=False)
+
+    expected = mapblock.Mapblock(blob, searchMetadata=False)
+    assert commands.delete_objects_block(expected, 0, args)
+    expected = expected.serialize()
+    assert mapblock.Mapblock(expected).node_metadata == metadata
+    assert mapblock.Mapblock(expected).static_object_count == 0
+
+    assert (pipeline.transform_block(0, blob, commands.delete_objects_block,
+            args) == expected)
+    assert list(pipeline.transform_threaded([[(0, blob)]],
+            commands.delete_objects_block, args, 2, threading.Lock(),
+            readsNodeData=False)) == [[(0, expected)]]
+    assert list(pipeline.transform_threaded([[(0, blob)]],
+            commands.delete_objects_block, args, 2, threading.Lock(),
+            readsNodeData=True)) == [[(0, expected)]]
@@ -0,0 +1,118 @@
+import sqlite3
+import sys
+from mapedit import utils, nodeindex, cmdline, mapblock
+from tests.helpers import make_block, make_map_file
+
+
+def open_map(mapFile):
+    db = utils.DatabaseHandler(mapFile)
+    db.node_index = nodeindex.NodeIndex(db, mapFile + ".nodeindex")
+    return db
+
+
+def write_block(mapFile, key, data):
+    """Change a block without MapEdit."""
+    database = sqlite3.connect(mapFile)
+    if data == None:
+        database.execute("DELETE FROM blocks WHERE pos = ?", (key,))
+    else:
+        database.execute("INSERT OR REPLACE INTO blocks VALUES (?, ?)",
+                (key, data))
+    database.commit()
+    database.close()
+
+
+def search(db, name, **kwargs):
+    selection = utils.BlockSelection(db, searchNode=name, **kwargs)
+    return [key for batch in selection for key, data in batch]
+
+
+def make_same_length_change(tmp_path):
+    mapFile = str(tmp_path / "map.sqlite")
+    make_map_file(mapFile, [(0, make_block([b"default:dirt"])),
+                            (1, make_block([b"default:sand"]))])
+
+    db = open_map(mapFile)
+    db.node_index.sync()
+    db.commit()
+    db.close()
+
+    newData = make_block([b"default:mese"])
+    assert len(newData) == len(make_block([b"default:sand"]))
+    write_block(mapFile, 1, newData)
+    return mapFile
+
+
+def test_read_finds_same_length_changes(tmp_path):
+    mapFile = make_same_length_change(tmp_path)
+
+    db = open_map(mapFile)
+    # The change is only seen once the block listed under its old node
+    # is read.
+    assert search(db, b"default:mese") == []
+    assert search(db, b"default:sand") == []
+    assert search(db, b"default:mese") == [1]
+    db.close()
+
+
+def test_verify_finds_same_length_changes(tmp_path):
+    mapFile = make_same_length_change(tmp_path)
+
+    db = open_map(mapFile)
+    db.node_index.verify()
+    assert search(db, b"default:mese") == [1]
+    assert search(db, b"default:sand") == []
+    db.close()
+
+
+def test_sync_only_checks_selected_area(tmp_path):
+    mapFile = str(tmp_path / "map.sqlite")
+    inside = utils.Vec3(0, 0, 0).to_block_key()
+    outside = utils.Vec3(5, 0, 0).to_block_key()
+    make_map_file(mapFile, [(inside, make_block([b"default:dirt"])),
+                            (outside, make_block([b"default:dirt"]))])
+
+    db = open_map(mapFile)
+    db.node_index.sync()
+    db.commit()
+    db.close()
+
+    write_block(mapFile, inside, None)
+    write_block(mapFile, outside, None)
+    write_block(mapFile, inside + 1, make_block([b"default:stone"]))
+    write_block(mapFile, outside + 1, make_block([b"default:stone"]))
+
+    db = open_map(mapFile)
+    area = utils.Area(utils.Vec3(0, 0, 0), utils.Vec3(31, 15, 15))
+    assert search(db, b"default:stone", area=area) == [inside + 1]
+    # Blocks outside the area were not checked.
+    assert [key for key, hash in db.node_index.get_blocks(b"default:dirt")
+            ] == [outside]
+    assert [key for key, hash in db.node_index.get_blocks(b"default:stone")
+            ] == [inside + 1]
+
+    assert search(db, b"default:stone") == [inside + 1, outside + 1]
+    assert db.node_index.get_blocks(b"default:dirt") == []
+    db.close()
+
+
+def test_batch_commands_do_not_sync(tmp_path, monkeypatch):
+    mapFile = str(tmp_path / "map.sqlite")
+    scriptFile = tmp_path / "script.txt"
+    make_map_file(mapFile, [(0, make_block([b"default:dirt"]))])
+    scriptFile.write_text("replacenodes default:dirt default:stone\n"
+            "setparam2 --searchnode default:stone 5\n")
+
+    syncs = []
+    monkeypatch.setattr(nodeindex.NodeIndex, "sync",
+            lambda self, keyRanges=None: syncs.append(self))
+    monkeypatch.setattr(sys, "argv", ["mapedit", "-f", mapFile,
+            "--no-warnings", "--node-index", "batch", str(scriptFile)])
+    cmdline.run_cmdline()
+
+    assert syncs == []
+    db = utils.DatabaseHandler(mapFile)
+    block = mapblock.Mapblock(db.get_block(0))
+    assert block.deserialize_nimap() == [b"default:stone"]
+    assert set(block.deserialize_node_data()[2].ravel()) == {5}
+    db.close()
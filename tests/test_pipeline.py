@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import pickle
+import threading
+import zlib
+import numpy as np
+from mapedit import pipeline, commands, blockfuncs, utils
+from tests.helpers import make_block, make_node_data
+
+
+def make_fill_args():
+    return argparse.Namespace(
+        replacenode_b=b"default:dirt",
+        # Covers part of the first mapblock only.
+        area=utils.Area(utils.Vec3(2, 3, 4), utils.Vec3(20, 9, 10)),
+        invert=False,
+        blockmode=False,
+        fill_templates=blockfuncs.FillTemplates())
+
+
+def make_batches():
+    nodeData = np.arange(4096, dtype=">u2").reshape((16, 16, 16)) % 2
+    blob = make_block([b"default:stone", b"air"], nodeData=nodeData)
+    return [[(0, blob), (1, blob)], [(2, blob)]]
+
+
+def test_area_pickle():
+    area = utils.Area(utils.Vec3(-5, 0, 3), utils.Vec3(40, 50, 60))
+    assert pickle.loads(pickle.dumps(area)) == area
+
+
+def test_transform_parallel_spawn(monkeypatch):
+    # Spawned workers get the transform arguments by pickling them.
+    monkeypatch.setattr(pipeline, "multiprocessing",
+            multiprocessing.get_context("spawn"))
+
+    expected = list(pipeline.transform_serial(make_batches(),
+            commands.fill_block, make_fill_args()))
+    results = []
+
+    def run():
+        results.extend(pipeline.transform_parallel(make_batches(),
+                commands.fill_block, make_fill_args(), 2))
+
+    # A worker which fails to start is replaced forever, so don't wait
+    # on the pool indefinitely.
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(120)
+
+    assert not thread.is_alive(), "worker processes failed to start"
+    assert results == expected
+    assert all(data != None for batch in results for key, data in batch)
+
+
+def test_transform_threaded_keeps_node_data_compressed():
+    blob = make_block([b"default:stone"])
+    args = argparse.Namespace()
+    decompressed = []
+
+    def transform(block, key, args):
+        decompressed.append(block._node_data_raw != None)
+        block.serialize_nimap([b"default:dirt"])
+        return True
+
+    results = list(pipeline.transform_threaded([[(0, blob)]], transform,
+            args, 2, threading.Lock(), readsNodeData=False))
+
+    # The node data was not decompressed ahead, and was copied as-is.
+    assert decompressed == [False]
+    compressed = zlib.compress(make_node_data())
+    assert blob[6:6 + len(compressed)] == compressed
+    assert results[0][0][1][6:6 + len(compressed)] == compressed
+    assert results == list(pipeline.transform_serial([[(0, blob)]],
+            transform, args))
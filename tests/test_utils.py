@@ -0,0 +1,208 @@
+import bisect
+import itertools
+import sqlite3
+import sys
+import numpy as np
+import pytest
+from mapedit import utils, commands, cmdline
+from tests.helpers import make_map_file
+
+
+def get_journal_mode(filename):
+    database = sqlite3.connect(filename)
+    mode = database.execute("PRAGMA journal_mode").fetchone()[0]
+    database.close()
+    return mode
+
+
+def test_close_restores_only_main_journal_mode(tmp_path):
+    mapFile = str(tmp_path / "map.sqlite")
+    inputFile = str(tmp_path / "input.sqlite")
+    make_map_file(mapFile)
+    make_map_file(inputFile)
+
+    database = sqlite3.connect(inputFile)
+    database.execute("PRAGMA journal_mode = WAL").fetchall()
+    database.close()
+
+    db = utils.DatabaseHandler(mapFile, profile="fast")
+    db.attach(inputFile, "source")
+    assert get_journal_mode(mapFile) == "wal"
+    db.close()
+
+    assert get_journal_mode(mapFile) == "delete"
+    assert get_journal_mode(inputFile) == "wal"
+
+
+def test_interrupt_restores_journal_mode(tmp_path, monkeypatch):
+    mapFile = str(tmp_path / "map.sqlite")
+    make_map_file(mapFile)
+
+    def interrupt(inst, args):
+        assert get_journal_mode(mapFile) == "wal"
+        raise KeyboardInterrupt()
+
+    monkeypatch.setitem(commands.COMMAND_DEFS["deleteblocks"], "func",
+            interrupt)
+    monkeypatch.setattr(sys, "argv", ["mapedit", "-f", mapFile,
+            "--no-warnings", "--db-profile", "fast", "deleteblocks",
+            "--p1", "0", "0", "0", "--p2", "10", "10", "10"])
+
+    with pytest.raises(KeyboardInterrupt):
+        cmdline.run_cmdline()
+
+    assert get_journal_mode(mapFile) == "delete"
+
+
+
+def test_finished_only_after_success(tmp_path, monkeypatch, capsys):
+    mapFile = str(tmp_path / "map.sqlite")
+    make_map_file(mapFile)
+    argv = ["mapedit", "-f", mapFile, "--no-warnings", "deleteblocks",
+            "--p1", "0", "0", "0", "--p2", "10", "10", "10"]
+
+    monkeypatch.setattr(sys, "argv", argv)
+    cmdline.run_cmdline()
+    assert "INFO: Finished." in capsys.readouterr().out
+
+    def interrupt(inst, args):
+        inst.begin()
+        raise KeyboardInterrupt()
+
+    monkeypatch.setitem(commands.COMMAND_DEFS["deleteblocks"], "func",
+            interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        cmdline.run_cmdline()
+    assert "INFO: Finished." not in capsys.readouterr().out
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, "setlimit"),
+        reason="Connection.setlimit requires Python 3.11")
+def test_copy_blocks_variable_limit(tmp_path):
+    mapFile = str(tmp_path / "map.sqlite")
+    inputFile = str(tmp_path / "input.sqlite")
+    make_map_file(mapFile)
+    make_map_file(inputFile, [(key, b"\x1c\x00") for key in range(2000)])
+
+    db = utils.DatabaseHandler(mapFile)
+    db.database.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER,
+            utils.MAX_SQL_VARIABLES)
+    db.attach(inputFile, "source")
+
+    keys = list(range(commands.COPY_BATCH_SIZE))
+    assert db.copy_blocks(keys, 5000, "source") == len(keys)
+    db.close()
+
+
+@pytest.mark.skipif(not hasattr(sqlite3.Connection, "setlimit"),
+        reason="Connection.setlimit requires Python 3.11")
+def test_get_many_keys_variable_limit(tmp_path):
+    mapFile = str(tmp_path / "map.sqlite")
+    make_map_file(mapFile, [(key, b"\x1c\x00") for key in range(2000)])
+
+    db = utils.DatabaseHandler(mapFile)
+    db.database.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER,
+            utils.MAX_SQL_VARIABLES)
+
+    keys = list(range(0, 3000, 2))
+    rows = [row for batch in db.get_many_keys(1000, keys) for row in batch]
+    assert [key for key, data in rows] == list(range(0, 2000, 2))
+    db.close()
+
+
+# Block coordinates around the edges and the middle of the map.
+EDGE_COORDS = [-2048, -2047, -2046, -1, 0, 1, 2045, 2046, 2047]
+
+
+def in_ranges(ranges, key):
+    i = bisect.bisect_right(ranges, (key, float("inf"))) - 1
+    return i >= 0 and ranges[i][0] <= key <= ranges[i][1]
+
+
+def check_key_ranges(blockArea):
+    for invert in (False, True):
+        ranges = utils.get_block_key_ranges(blockArea, invert)
+
+        if ranges == None:
+            # Only returned for areas with too many rows to query.
+            p1 = np.maximum(blockArea.p1, utils.MIN_BLOCK_POS)
+            p2 = np.minimum(blockArea.p2, utils.MAX_BLOCK_POS)
+            assert np.prod((p2 - p1 + 1)[1:]) > utils.MAX_KEY_RANGES
+            continue
+
+        # Ranges are sorted, separate and within the map.
+        for (first, last), (nextFirst, nextLast) in zip(ranges, ranges[1:]):
+            assert first <= last < nextFirst - 1 < nextLast
+        for first, last in ranges:
+            assert utils.MIN_BLOCK_POS.to_block_key() <= first
+            assert last <= utils.MAX_BLOCK_POS.to_block_key()
+
+        for pos in itertools.product(EDGE_COORDS, repeat=3):
+            pos = utils.Vec3(*pos)
+            key = pos.to_block_key()
+            assert utils.Vec3.from_block_key(key) == pos
+            assert in_ranges(ranges, key) == (blockArea.contains(pos)
+                    != invert), (blockArea, invert, pos)
+
+
+def test_block_key_ranges_at_map_edges():
+    areas = [
+        # Whole layers, reaching past the edges of the map.
+        ((-2048, -2048, -2048), (2047, 2047, -2046)),
+        ((-3000, -3000, 2046), (3000, 3000, 3000)),
+        # Single blocks in the corners.
+        (utils.MIN_BLOCK_POS, utils.MIN_BLOCK_POS),
+        (utils.MAX_BLOCK_POS, utils.MAX_BLOCK_POS),
+        ((2047, -2048, 2047), (2047, -2048, 2047)),
+        # Whole rows along the X axis, which merge into one range.
+        ((-2048, -2047, -1), (2047, 1, 0)),
+        ((-2100, 2045, 2045), (2100, 2100, 2100)),
+        # Partial rows crossing the edges.
+        ((2046, -2049, -2049), (2050, -2047, 0)),
+        ((-2049, 0, 2046), (-2047, 2047, 2049)),
+        # Outside the map, and empty.
+        ((2048, 0, 0), (2100, 1, 1)),
+        ((0, 0, 0), (-1, 5, 5)),
+    ]
+
+    for p1, p2 in areas:
+        check_key_ranges(utils.Area(utils.Vec3(*p1), utils.Vec3(*p2)))
+
+
+def test_block_key_ranges_random_areas():
+    rng = np.random.default_rng(0)
+
+    for i in range(50):
+        (p1, p2) = np.sort(rng.choice(EDGE_COORDS, (2, 3)) +
+                rng.integers(-2, 3, (2, 3)), axis=0)
+        check_key_ranges(utils.Area(utils.Vec3(*p1.tolist()),
+                utils.Vec3(*p2.tolist())))
+
+
+def test_block_key_ranges_too_many():
+    blockArea = utils.Area(utils.Vec3(0, -2048, -2048),
+            utils.Vec3(0, 2047, 2047))
+    assert utils.get_block_key_ranges(blockArea) == None
+    assert utils.get_block_key_ranges(blockArea, invert=True) == None
+
+
+def test_key_checksum_list_and_array():
+    rng = np.random.default_rng(0)
+    keys = np.concatenate([
+            rng.integers(utils.MIN_BLOCK_POS.to_block_key(),
+                    utils.MAX_BLOCK_POS.to_block_key() + 1, 10000),
+            [utils.MIN_BLOCK_POS.to_block_key(),
+                    utils.MAX_BLOCK_POS.to_block_key(), 0, -1]])
+    removed = rng.choice(keys, 3000, replace=False)
+
+    fromList = utils.KeyChecksum(keys.tolist())
+    fromArray = utils.KeyChecksum(keys)
+    assert str(fromList) == str(fromArray)
+
+    fromList.remove_all(removed.tolist())
+    fromArray.remove_all(removed)
+    assert str(fromList) == str(fromArray)
+
+    # Both paths can be mixed.
+    fromList.remove_all(np.setdiff1d(keys, removed))
+    fromArray.remove_all(np.setdiff1d(keys, removed).tolist())
+    assert str(fromList) == str(fromArray) == str(utils.KeyChecksum())